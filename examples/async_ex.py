@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+
+"""
+Asynchronous lookups.  The lookups return right away and the callback
+is called with the result, or with an exception on a timeout, from
+another thread.  For resolving large lists of names, see
+"python -m pyresolv --help".
+"""
+
+from pyresolv import *
+from pyresolv.adns import ADNS
+import threading , sys
+
+def main():
+    names = sys.argv[1:] or ['example.com' , 'example.net']
+    done = threading.Semaphore(0)
+    lock = threading.Lock()
+
+    def callback(res , name=None):
+        with lock:
+            if isinstance(res , Exception):
+                print '%s: %s' % (name , res)
+            else:
+                print '%s: %r' % (name , res.answers)
+        done.release()
+
+    # Uses the resolvers in /etc/resolv.conf
+    resolver = ADNS(defaultTimeout=3.0)
+    for name in names:
+        # Extra keyword arguments are passed on to the callback
+        resolver.a(name , callback=callback , name=name)
+        resolver.mx(name , callback=callback , name=name)
+    # Wait for all the answers
+    for i in xrange(len(names) * 2):
+        done.acquire()
+    resolver.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the batched (sendmmsg/recvmmsg) datagram paths against the
+per-packet send()/recv() calls.  This runs entirely over localhost and
+prints the packets per second for each path.
+"""
+
+from pyresolv import dnsreqres as drr
+from pyresolv import mmsg
+from optparse import OptionParser
+import socket , time , sys
+
+def getOpts():
+    p = OptionParser()
+    p.add_option('-n' , '--num-packets' , dest='num' , type='int' ,
+        default=200000 , help='The number of packets to move in each '
+        'test [default: %default]')
+    p.add_option('-b' , '--batch' , dest='batch' , type='int' ,
+        default=64 , help='The number of packets per batch '
+        '[default: %default]')
+    opts , args = p.parse_args()
+    return opts
+
+def getPair():
+    """
+    Returns a pair of UDP sockets connected to each other
+    """
+    a = socket.socket(socket.AF_INET , socket.SOCK_DGRAM)
+    b = socket.socket(socket.AF_INET , socket.SOCK_DGRAM)
+    for s in (a , b):
+        s.setsockopt(socket.SOL_SOCKET , socket.SO_RCVBUF , 8 * 1024 * 1024)
+        s.bind(('127.0.0.1' , 0))
+    a.connect(b.getsockname())
+    b.connect(a.getsockname())
+    return a , b
+
+def benchSend(num , batch , useMmsg):
+    a , b = getPair()
+    receiver = mmsg.MmsgReceiver(batch , useMmsg=True)
+    packets = [drr.DnsRequest('www%d.example.com' % i).getBuf()
+        for i in xrange(batch)]
+    sent = 0
+    elapsed = 0.0
+    while sent < num:
+        start = time.time()
+        sent += mmsg.sendMany(a , packets , useMmsg)
+        elapsed += time.time() - start
+        # Drain the receiving side so we don't drop packets, this is
+        # not timed
+        got = 0
+        while got < len(packets):
+            got += len(receiver.recv(b))
+    a.close()
+    b.close()
+    return sent / elapsed
+
+def benchRecv(num , batch , useMmsg):
+    a , b = getPair()
+    receiver = mmsg.MmsgReceiver(batch , useMmsg=useMmsg)
+    packets = [drr.DnsRequest('www%d.example.com' % i).getBuf()
+        for i in xrange(batch)]
+    got = 0
+    elapsed = 0.0
+    while got < num:
+        # Fill the socket buffer, this is not timed
+        mmsg.sendMany(a , packets , True)
+        want = got + len(packets)
+        start = time.time()
+        while got < want:
+            got += len(receiver.recv(b))
+        elapsed += time.time() - start
+    a.close()
+    b.close()
+    return got / elapsed
+
+def main():
+    opts = getOpts()
+    if not mmsg.HAVE_MMSG:
+        print >> sys.stderr , 'sendmmsg/recvmmsg are not available here'
+        sys.exit(1)
+    for name , func in (('send' , benchSend) , ('recv' , benchRecv)):
+        single = func(opts.num , opts.batch , False)
+        batched = func(opts.num , opts.batch , True)
+        print '%s: per-packet %d pps, batched %d pps (%.1fx)' % (name ,
+            single , batched , batched / single)
+
+if __name__ == '__main__':
+    main()
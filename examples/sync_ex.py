@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+
+"""
+Synchronous lookups.  Each lookup blocks until the answer comes back,
+while batch() sends a whole list of queries at once and waits for all
+of them.
+"""
+
+from pyresolv import *
+from pyresolv.errors import TimeoutError
+import sys
+
+def main():
+    names = sys.argv[1:] or ['example.com' , 'example.net']
+    # Uses the resolvers in /etc/resolv.conf
+    resolver = DNS(defaultTimeout=3.0 , cache=DnsCache())
+    for name in names:
+        try:
+            res = resolver.a(name)
+        except TimeoutError , e:
+            print '%s: %s' % (name , e)
+            continue
+        for qname , qtype , qclass , ttl , addr in res.answers:
+            print '%s %d %s' % (qname , ttl , addr)
+    # Look up the MX records for all of the names at once
+    for req , res in resolver.batch([(name , QT_MX) for name in names]):
+        if isinstance(res , Exception):
+            print '%s: %s' % (req.qname , res)
+        else:
+            print '%s: %r' % (req.qname , res.answers)
+
+if __name__ == '__main__':
+    main()
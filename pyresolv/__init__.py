@@ -35,11 +35,22 @@ QT_MINFO = 14
 QT_MX = 15
 QT_TXT = 16
 QT_AAAA = 28
+QT_SRV = 33
+QT_NAPTR = 35
+QT_DNAME = 39
+QT_OPT = 41     # EDNS pseudo record
+QT_DS = 43
+QT_RRSIG = 46
+QT_NSEC = 47
+QT_DNSKEY = 48
+QT_SVCB = 64
+QT_HTTPS = 65
 QT_AXFR = 252
 QT_MAILB = 253
 QT_MAILA = 254  # Obsolete, see MX
 QT_ALL = 255
 QT_ANY = QT_ALL # just an alias
+QT_CAA = 257
 
 # Classes
 CL_IN = 1
@@ -49,4 +60,5 @@ CL_HS = 4
 CL_ANY = 255
 
 from dns import DNS
+from cache import DnsCache , SharedDnsCache
 #from adns import ADNS
@@ -0,0 +1,196 @@
+"""
+Bulk resolution from the command line.  Names are read from stdin, one
+per line, and the results are written to stdout as JSON lines as they
+come in.  A throughput and latency summary is printed to stderr at the
+end.
+
+    python -m pyresolv -t MX --concurrency 2000 < names.txt
+"""
+
+from .adns import ADNS
+from .errors import ReqError , MissingDataError
+from optparse import OptionParser
+import pyresolv
+import threading , time , json , sys , signal , logging
+
+DEFAULT_CONCURRENCY = 1000
+
+def getOpts():
+    p = OptionParser(usage='python -m pyresolv [options] < names.txt')
+    p.add_option('-t' , '--type' , dest='qtype' , default='A' ,
+        help='The query type, as a name or a number [default: %default]')
+    p.add_option('-c' , '--concurrency' , dest='concurrency' , type='int' ,
+        default=DEFAULT_CONCURRENCY , help='The most queries to have in flight at once '
+        '[default: %default]')
+    p.add_option('-r' , '--resolver' , dest='resolvers' , action='append' ,
+        default=[] , help='A resolver to use.  Can be specified '
+        'multiple times.  Defaults to those in /etc/resolv.conf')
+    p.add_option('-p' , '--port' , dest='port' , type='int' , default=None ,
+        help='The resolver port [default: 53, or 853 with --tls]')
+    p.add_option('-T' , '--timeout' , dest='timeout' , type='float' ,
+        default=3.0 , help='The query timeout in seconds '
+        '[default: %default]')
+    p.add_option('--tls' , dest='tls' , action='store_true' ,
+        default=False , help='Query the resolvers over DNS over TLS')
+    p.add_option('--tls-name' , dest='tlsName' , default=None ,
+        help='The name to verify the resolvers\' certificates against')
+    p.add_option('-q' , '--quiet' , dest='quiet' , action='store_true' ,
+        default=False , help='Do not print the summary')
+    opts , args = p.parse_args()
+    try:
+        opts.qtype = getQType(opts.qtype)
+    except ValueError:
+        p.error('Unknown query type: %s' % opts.qtype)
+    if opts.concurrency < 1:
+        p.error('The concurrency must be at least 1')
+    return opts
+
+def getQType(qtype):
+    """
+    Returns the numeric query type for a name like "MX" or a number
+    """
+    if qtype.isdigit():
+        return int(qtype)
+    val = getattr(pyresolv , 'QT_%s' % qtype.upper() , None)
+    if val is None:
+        raise ValueError(qtype)
+    return val
+
+def _jsonable(val):
+    """
+    Convert record data to something json can serialize.  Binary data
+    that isn't valid text is hex encoded
+    """
+    if isinstance(val , str):
+        try:
+            return val.decode('utf-8')
+        except UnicodeDecodeError:
+            return val.encode('hex')
+    if isinstance(val , (list , tuple)):
+        return [_jsonable(v) for v in val]
+    if isinstance(val , dict):
+        return dict([(k , _jsonable(v)) for k , v in val.iteritems()])
+    return val
+
+class LatencyStats(object):
+    """
+    Tracks the query counts and a latency histogram with 1ms buckets.
+    This uses constant memory no matter how many queries are made
+    """
+    def __init__(self , maxMs):
+        self.hist = [0] * (int(maxMs) + 2)
+        self.ok = 0
+        self.errors = 0
+        self.total = 0.0
+        self.maxMs = 0.0
+
+    def add(self , ms , ok):
+        if ok:
+            self.ok += 1
+        else:
+            self.errors += 1
+        self.total += ms
+        self.maxMs = max(self.maxMs , ms)
+        self.hist[min(int(ms) , len(self.hist) - 1)] += 1
+
+    def percentile(self , pct):
+        """
+        Returns the latency in ms at the given percentile
+        """
+        want = (self.ok + self.errors) * pct / 100.0
+        seen = 0
+        for ms , count in enumerate(self.hist):
+            seen += count
+            if count and seen >= want:
+                return ms
+        return 0
+
+    def summary(self , elapsed):
+        count = self.ok + self.errors
+        if not count:
+            return 'No queries made'
+        return ('%d queries (%d ok, %d failed) in %.2fs: %.0f queries/s\n'
+            'latency ms: avg %.1f, p50 %d, p90 %d, p99 %d, max %.1f') % (
+            count , self.ok , self.errors , elapsed , count / elapsed ,
+            self.total / count , self.percentile(50) , self.percentile(90) ,
+            self.percentile(99) , self.maxMs)
+
+class BulkRunner(object):
+    """
+    Streams names through an ADNS resolver, keeping at most concurrency
+    queries in flight, and writes a JSON line per result
+    """
+    def __init__(self , resolver , qtype , concurrency , out=sys.stdout):
+        self.resolver = resolver
+        self.qtype = qtype
+        self.concurrency = concurrency
+        self.out = out
+        self.stats = LatencyStats(resolver.defTO * 1000)
+        self._slots = threading.Semaphore(concurrency)
+        self._lock = threading.Lock()
+
+    def run(self , names):
+        """
+        Resolve all the names in an iterable and wait for the results.
+        The iterable is consumed lazily
+        """
+        start = time.time()
+        for line in names:
+            name = line.strip()
+            if not name or name.startswith('#'):
+                continue
+            self._slots.acquire()
+            try:
+                self.resolver.lookup(name , self.qtype ,
+                    callback=self._onResult , name=name ,
+                    start=time.time())
+            except ReqError , e:
+                self._onResult(e , name , time.time())
+        # Wait for everything in flight to finish
+        for i in xrange(self.concurrency):
+            self._slots.acquire()
+        return time.time() - start
+
+    def _onResult(self , res , name=None , start=None):
+        ms = (time.time() - start) * 1000
+        rec = {'name': name , 'qtype': self.qtype , 'ms': round(ms , 3)}
+        if isinstance(res , Exception):
+            rec['error'] = '%s: %s' % (res.__class__.__name__ , res)
+        else:
+            rec['rcode'] = res.rcode
+            rec['answers'] = [_jsonable(a) for a in res.answers]
+        line = json.dumps(rec) + '\n'
+        try:
+            with self._lock:
+                self.stats.add(ms , not isinstance(res , Exception))
+                self.out.write(line)
+        except IOError , e:
+            # Most likely a closed pipe on stdout
+            logging.error('Failed to write the result for %s: %s' % (
+                name , e))
+        finally:
+            self._slots.release()
+
+def main():
+    opts = getOpts()
+    signal.signal(signal.SIGPIPE , signal.SIG_DFL)
+    try:
+        resolver = ADNS(opts.timeout , opts.resolvers ,
+            port=opts.port , useTls=opts.tls , tlsServerName=opts.tlsName ,
+            maxPending=opts.concurrency)
+    except (IOError , MissingDataError) , e:
+        print >> sys.stderr , 'Could not set up the resolver: %s' % e
+        sys.exit(1)
+    runner = BulkRunner(resolver , opts.qtype , opts.concurrency)
+    try:
+        elapsed = runner.run(sys.stdin)
+    except KeyboardInterrupt:
+        sys.exit(1)
+    finally:
+        resolver.close()
+        sys.stdout.flush()
+    if not opts.quiet:
+        print >> sys.stderr , runner.stats.summary(elapsed)
+
+if __name__ == '__main__':
+    main()
@@ -4,37 +4,95 @@ Asynchronous DNS library
 
 import dnsreqres as drr
 from basedns import BaseDNS
+from errors import TimeoutError , ResError
+from idalloc import SocketIdPool
+from mmsg import sendMany , MmsgReceiver
 from . import *
 import Queue
-import threading , socket , select
+import threading , socket , select , logging , time , heapq , itertools , \
+    os , fcntl , atexit , weakref
+
+# The receive buffer space to allow for each answer in flight.  The
+# kernel charges more than the datagram size for each one it queues
+RCVBUF_PER_ANSWER = 2048
+
+# The running instances.  Their event loops are stopped at exit, before
+# the interpreter tears down the modules they use
+_instances = weakref.WeakSet()
+
+def _closeAll():
+    for inst in list(_instances):
+        inst.close()
+        inst.join(1)
+
+atexit.register(_closeAll)
 
 class ADNS(BaseDNS , threading.Thread):
     """
     Asynchronous DNS library
     """
     def __init__(self , defaultTimeout=3.0 , resolvers=[] ,
-            resolvConf='/etc/resolv.conf' , useFirstOnly=True , 
-            defCallback=None):
+            resolvConf='/etc/resolv.conf' , useFirstOnly=True ,
+            defCallback=None , cache=None , maxInFlightPerSock=4096 ,
+            port=None , useMmsg=True , maxBatch=256 , useTls=False ,
+            tlsContext=None , tlsServerName=None , maxPending=1024 ,
+            callbackThreads=4):
         """
-        These are the options defined in BaseDNS.  The only difference
-        being the defCallback, defined below.
+        These are the options defined in BaseDNS, plus the ones
+        defined below.
 
         defCallback:func        The default callback to use if no callback
                                 is specified per query
+        maxInFlightPerSock:int  The number of outstanding queries on a
+                                single socket before another socket
+                                (with a different source port) is
+                                opened to the resolver
+        maxBatch:int            The most queued lookups to send at once
+                                on each pass of the event loop
+        maxPending:int          The most lookups to have in flight at
+                                once.  Any more wait in the queue until
+                                others finish.  The socket receive
+                                buffers are sized to hold this many
+                                answers
+        callbackThreads:int     The number of threads that run the
+                                callbacks.  If 0, callbacks are run in
+                                the event loop thread and must not
+                                block
         """
-        BaseDNS.__init__(self , defaultTimeout , resolvers , resolvConf , 
-            useFirstOnly)
+        BaseDNS.__init__(self , defaultTimeout , resolvers , resolvConf ,
+            useFirstOnly , cache , port , useMmsg , useTls , tlsContext ,
+            tlsServerName)
         threading.Thread.__init__(self)
+        self.maxInFlight = int(maxInFlightPerSock)
+        self.maxBatch = int(maxBatch)
+        self.maxPending = int(maxPending)
         # Create a thread-safe queue
         self._q = Queue.Queue()
-        # Need a map for request ids -> requests
-        self._reqMap = {}
+        # The number of lookups sent and not yet answered or timed out.
+        # This is only touched by the event loop
+        self._inFlight = 0
+        # The callbacks to run, as (callback , result , kwargs) tuples
+        self._cbq = Queue.Queue()
+        self._cbThreads = []
+        for i in xrange(int(callbackThreads)):
+            t = threading.Thread(target=self._callbackLoop)
+            t.daemon = True
+            t.start()
+            self._cbThreads.append(t)
         # Die when the program ends
         self.daemon = True
         # Create a close event for the main event loop
         self._close = threading.Event()
-        self._socks = []
+        # A pipe used to wake up the event loop when a lookup is queued.
+        # Neither end blocks, a full pipe already means a wakeup
+        self._wakeR , self._wakeW = os.pipe()
+        for fd in (self._wakeR , self._wakeW):
+            fcntl.fcntl(fd , fcntl.F_SETFL ,
+                fcntl.fcntl(fd , fcntl.F_GETFL) | os.O_NONBLOCK)
+        # One SocketIdPool per resolver
+        self._pools = []
         self._openSockets()
+        _instances.add(self)
         self.start()
 
     def run(self):
@@ -43,60 +101,232 @@ class ADNS(BaseDNS , threading.Thread):
         """
         pMask = select.EPOLLIN | select.EPOLLPRI
         p = select.poll()
+        p.register(self._wakeR , pMask)
         fdMap = {}
+        # Map of (fd , id) -> the pending request entry.  Each entry is
+        # a list of [req , callback , kwargs , [(pool , sock , id) , ...]]
         reqMap = {}
-        # Register the socket file descriptors in the poll object
-        for s in self._socks:
-            fd = s.fileno()
-            p.register(fd , pMask)
-            fdMap[fd] = s
+        # A heap of (deadline , seq , entry) for timing out requests
+        deadlines = []
+        seq = itertools.count()
+        receiver = MmsgReceiver(useMmsg=self.useMmsg)
         # Start the main loop
         while not self._close.isSet():
-            new = None
-            # Get any new lookups
-            try:
-                new = self._q.get_nowait()
-            except Queue.Empty:
-                # Nothing waiting, pass
-                pass
-            # Do the new lookup
-            if new:
-                req = new[0]
-                for s in self._socks:
-                    s.sendall(req.getBuf())
-                reqMap[req.id] = new
-            # Poll for results
-            for fd , evt in p.poll(0.01):
-                sock = fdMap[fd]
-                packet = sock.recv(65535)
-                res = drr.DnsResult(packet)
-                if res.id not in reqMap:
-                    logging.warning('Found non-matching id in '
-                        'result, dropping: %s' % res.id)
+            # Map of fd -> [sock , [packets to send]]
+            outgoing = {}
+            # Get any new lookups, up to maxBatch at a time and as long
+            # as we are under maxPending
+            for i in xrange(min(self.maxBatch ,
+                    self.maxPending - self._inFlight)):
+                try:
+                    new = self._q.get_nowait()
+                except Queue.Empty:
+                    # Nothing waiting
+                    break
+                req , timeout , cb , kwargs = new
+                entry = [req , cb , kwargs , []]
+                for pool in self._pools:
+                    sock , id = pool.alloc()
+                    if sock is None:
+                        logging.warning('No free ids for query %s' %
+                            req.qname)
+                        continue
+                    fd = sock.fileno()
+                    if fd not in fdMap:
+                        # A new socket was opened by the pool
+                        p.register(fd , pMask)
+                        fdMap[fd] = sock
+                    req.setId(id)
+                    outgoing.setdefault(fd , [sock , []])[1].append(
+                        req.getBuf())
+                    reqMap[(fd , id)] = entry
+                    entry[3].append((pool , sock , id))
+                if entry[3]:
+                    self._inFlight += 1
+                    heapq.heappush(deadlines , (time.time() + timeout ,
+                        seq.next() , entry))
+                else:
+                    self._runCallback(cb , ResError('Too many queries in '
+                        'flight for %s' % req.qname) , kwargs)
+            # Send all the new lookups
+            for sock , packets in outgoing.itervalues():
+                try:
+                    sendMany(sock , packets , self.useMmsg)
+                except socket.error , e:
+                    # The lookups on this socket will time out
+                    logging.warning('Failed to send queries: %s' % e)
+            # Poll for results.  Don't wait if there are more lookups
+            # queued than we took this time around and room to send them
+            wait = 10
+            if self._q.qsize() and self._inFlight < self.maxPending:
+                wait = 0
+            for fd , evt in p.poll(wait):
+                if fd == self._wakeR:
+                    self._drainWake()
+                    continue
+                try:
+                    packets = receiver.recv(fdMap[fd])
+                except socket.error , e:
+                    logging.warning('Failed to read results: %s' % e)
                     continue
-                cb , kwargs = reqMap[res.id][2:]
-                t = threading.Thread(target=cb , args=(res,) , 
-                    kwargs=kwargs)
-                # Don't block shutdown
-                t.daemon = True
-                t.start()
+                for packet in packets:
+                    try:
+                        res = drr.DnsResult(packet)
+                    except ResError , e:
+                        logging.warning('Dropping invalid result: %s' % e)
+                        continue
+                    entry = reqMap.get((fd , res.id))
+                    if entry is None:
+                        logging.warning('Found non-matching id in '
+                            'result, dropping: %s' % res.id)
+                        continue
+                    self._finish(entry , reqMap)
+                    self._cacheResult(res)
+                    self._runCallback(entry[1] , res , entry[2])
+            # Time out any expired requests
+            now = time.time()
+            while deadlines and deadlines[0][0] <= now:
+                deadline , n , entry = heapq.heappop(deadlines)
+                if not entry[3]:
+                    # Already answered
+                    continue
+                self._finish(entry , reqMap)
+                self._runCallback(entry[1] , TimeoutError('Hit timeout '
+                    'when querying for %s' % entry[0].qname) , entry[2])
         # Cleanup
-        for s in self._socks:
-            s.close()
+        for pool in self._pools:
+            pool.close()
+        os.close(self._wakeR)
+        os.close(self._wakeW)
 
     def close(self):
         """
-        Set the close event
+        Set the close event and close any TLS connections
         """
         self._close.set()
+        self._wake()
+        for t in self._cbThreads:
+            self._cbq.put(None)
+        BaseDNS.close(self)
+
+    def _wake(self):
+        try:
+            os.write(self._wakeW , 'x')
+        except OSError:
+            # Either the pipe is full, so a wakeup is pending anyway,
+            # or the loop has already shut down
+            pass
+
+    def _drainWake(self):
+        try:
+            while os.read(self._wakeR , 4096):
+                pass
+        except OSError:
+            pass
+
+    def _finish(self , entry , reqMap):
+        """
+        Release the ids for a request that has been answered or has
+        timed out
+        """
+        if entry[3]:
+            self._inFlight -= 1
+        for pool , sock , id in entry[3]:
+            reqMap.pop((sock.fileno() , id) , None)
+            pool.release(sock , id)
+        entry[3] = []
+
+    def _runCallback(self , cb , res , kwargs):
+        """
+        Hand the callback to the callback threads, or run it now if
+        there aren't any
+        """
+        if self._cbThreads:
+            self._cbq.put((cb , res , kwargs))
+        else:
+            self._callCallback(cb , res , kwargs)
+
+    def _callbackLoop(self):
+        while True:
+            item = self._cbq.get()
+            if item is None:
+                break
+            self._callCallback(*item)
+
+    def _callCallback(self , cb , res , kwargs):
+        try:
+            cb(res , **kwargs)
+        except Exception , e:
+            # Don't let a bad callback take down the thread
+            logging.exception('Error in callback: %s' % e)
+
+    def _cacheHit(self , res , callback=None , **kwargs):
+        """
+        Results found in the cache are passed straight to the callback
+        """
+        self._runCallback(callback , res , kwargs)
 
     def _openSockets(self):
+        if self.useTls:
+            # Queries go over the persistent TLS connections instead
+            return
         for resolver in self.resolvers:
-            # Get a socket connection for each resolver
-            self._socks.append(self._getSock(resolver , self.defTO))
+            # Get a pool of socket connections for each resolver
+            factory = lambda r=resolver: self._newSock(r)
+            self._pools.append(SocketIdPool(factory , self.maxInFlight))
             if self.useFirst: break
 
+    def _newSock(self , resolver):
+        """
+        Open a socket to the resolver with a receive buffer big enough
+        that answers aren't dropped while the event loop is busy
+        """
+        sock = self._getSock(resolver , self.defTO)
+        size = min(self.maxPending , self.maxInFlight) * RCVBUF_PER_ANSWER
+        if sock.getsockopt(socket.SOL_SOCKET , socket.SO_RCVBUF) < size:
+            # The kernel caps this at net.core.rmem_max
+            sock.setsockopt(socket.SOL_SOCKET , socket.SO_RCVBUF , size)
+        return sock
+
     def _doLookup(self , req , timeout , callback=None , **kwargs):
-        if not self._close.isSet():
+        """
+        Queue up the request.  The callback will be called with the
+        DnsResult, or with a TimeoutError if no answer comes back in
+        time
+        """
+        if self._close.isSet():
+            return
+        if self.useTls:
+            self._tlsSubmit(req , timeout , callback , kwargs)
+        else:
             # Add a tuple of (req , timeout , callback) to the queue
             self._q.put((req , timeout , callback , kwargs))
+            self._wake()
+
+    def _tlsSubmit(self , req , timeout , callback , kwargs , idx=0):
+        """
+        Pipeline the request on the TLS connection to the resolver at
+        idx in the resolver list
+        """
+        conn = self._getDot(self.resolvers[idx])
+        try:
+            conn.submit(req , timeout , self._onTlsAnswer ,
+                lookup=(req , timeout , callback , kwargs , idx))
+        except ResError , e:
+            self._onTlsAnswer(e , (req , timeout , callback , kwargs , idx))
+
+    def _onTlsAnswer(self , res , lookup):
+        """
+        Called from the connection's I/O thread with the result of a
+        TLS lookup.  Failures are retried on the next resolver unless
+        we are only using the first one
+        """
+        req , timeout , callback , cbArgs , idx = lookup
+        if isinstance(res , Exception):
+            if not self.useFirst and idx + 1 < len(self.resolvers) and \
+                    not self._close.isSet():
+                self._tlsSubmit(req , timeout , callback , cbArgs , idx + 1)
+                return
+        else:
+            self._cacheResult(res)
+        self._runCallback(callback , res , cbArgs)
@@ -1,8 +1,10 @@
 
 import dnsreqres as drr
+from dot import DotConnection , DOT_PORT
+from errors import ReqError , MissingDataError
 # Import all the constants
 from . import *
-import re , socket
+import re , socket , threading
 
 # Basic checks here for ip
 RE_IPV4 = re.compile(r'^(?:\d{1,3}\.){3}\d{1,3}$')
@@ -12,7 +14,9 @@ class BaseDNS(object):
     The base DNS class
     """
     def __init__(self , defaultTimeout=3.0 , resolvers=[] , 
-            resolvConf='/etc/resolv.conf' , useFirstOnly=True):
+            resolvConf='/etc/resolv.conf' , useFirstOnly=True , cache=None ,
+            port=None , useMmsg=True , useTls=False , tlsContext=None ,
+            tlsServerName=None):
         """
         Initialize the library with the default timeout (can be 
         overridden in each request) and resolvers
@@ -31,11 +35,39 @@ class BaseDNS(object):
                                 all resolvers are tried simultaneously
                                 and the first to respond is what is
                                 returned.
+        cache:DnsCache          An optional cache.DnsCache instance.  If
+                                set, answers will be returned from the
+                                cache when possible and new results
+                                will be added to it
+        port:int                The port the resolvers listen on.  This
+                                defaults to 53, or 853 with useTls
+        useMmsg:bool            Use sendmmsg()/recvmmsg() to send and
+                                receive many packets per syscall in
+                                the bulk paths, where available
+        useTls:bool             Send all queries over DNS over TLS
+                                (RFC 7858).  A persistent, pipelined
+                                connection is kept to each resolver
+        tlsContext:SSLContext   The ssl context to use for TLS.  A
+                                default, verifying context is used if
+                                not set
+        tlsServerName:str       The name to verify the resolvers'
+                                certificates against
         """
         self.defTO = float(defaultTimeout)
         self.resolvers = resolvers
         self.resolvConf = resolvConf
         self.useFirst = useFirstOnly
+        self.cache = cache
+        self.useTls = useTls
+        self.tlsContext = tlsContext
+        self.tlsServerName = tlsServerName
+        if port is None:
+            port = DOT_PORT if useTls else 53
+        self.port = int(port)
+        self.useMmsg = useMmsg
+        # Map of resolver IP to its DotConnection when using TLS
+        self._dots = {}
+        self._dotLock = threading.Lock()
         # Map for resolver IP to address family
         self._resvMap = {}
         # list for requests
@@ -70,6 +102,10 @@ class BaseDNS(object):
                         arbitrary keyword arguments that will be 
                         passed on to the callback
         """
+        if self.cache is not None:
+            res = self.cache.get(query , qtype , qclass)
+            if res is not None:
+                return self._cacheHit(res , callback=callback , **kwargs)
         # Get a request object
         req = drr.DnsRequest(query , qtype=qtype , qclass=qclass , 
             opcode=opcode , rd=rd)
@@ -180,27 +216,8 @@ class BaseDNS(object):
                         arbitrary keyword args that will also be
                         passed to the callback
         """
-        family = socket.AF_INET
-        suffix = 'in-addr.arpa'
-        if ':' in query:
-            # We presume this is a v6 addr
-            family = socket.AF_INET6
-            suffix = 'ipv6.arpa'
-        # Create a byte list buffer
-        bl = []
-        try:
-            # convert to a string
-            ipStr = socket.inet_pton(family , query)
-        except Exception , e:
-            # We have an invalid IP specification
-            raise ReqError('Your specification for a reverse has an invalid '
-                'IP address %s: %s' % (query , str(e)))
-        # We loop through the raw hex bytes here in reverse and convert 
-        # them to decimal string values
-        for i in ipStr[::-1]:
-            bl.append(str(ord(i)))
-        # Get the arpa str to lookup
-        realQ = '%s.%s' % ('.'.join(bl) , suffix)
+        suffix = 'ip6.arpa' if ':' in query else 'in-addr.arpa'
+        realQ = '%s.%s' % (self._reverseName(query) , suffix)
         return self.ptr(realQ , callback=callback , **kwargs)
 
     def axfr(self , query , callback=None , **kwargs):
@@ -225,12 +242,78 @@ class BaseDNS(object):
         """
         return self.lookup(query , QT_ALL , callback=callback , **kwargs)
 
+    def _reverseName(self , ip):
+        """
+        Returns the labels of an IP address in reverse, as used in
+        reverse and DNSBL lookups.  IPv4 addresses are reversed by octet
+        and IPv6 addresses by nibble (RFC 3596).  This does not include
+        a suffix like in-addr.arpa
+        """
+        family = socket.AF_INET
+        if ':' in ip:
+            # We presume this is a v6 addr
+            family = socket.AF_INET6
+        try:
+            # convert to a string
+            ipStr = socket.inet_pton(family , ip)
+        except Exception , e:
+            # We have an invalid IP specification
+            raise ReqError('Your specification for a reverse has an invalid '
+                'IP address %s: %s' % (ip , str(e)))
+        if family == socket.AF_INET6:
+            return '.'.join(ipStr.encode('hex')[::-1])
+        # We loop through the raw bytes here in reverse and convert
+        # them to decimal string values
+        return '.'.join([str(ord(i)) for i in ipStr[::-1]])
+
     def _getSock(self , resolver , timeout):
-        s = socket.socket(socket.AF_INET , socket.SOCK_DGRAM)
+        family = self._resvMap.get(resolver)
+        if family is None:
+            # Not one of our resolvers, such as a nameserver found while
+            # resolving iteratively
+            family = socket.AF_INET6 if ':' in resolver else socket.AF_INET
+        s = socket.socket(family , socket.SOCK_DGRAM)
         s.settimeout(float(timeout))
-        s.connect((resolver , 53))
+        s.connect((resolver , self.port))
         return s
 
+    def _getDot(self , resolver):
+        """
+        Returns the persistent TLS connection to a resolver, creating it
+        on first use
+        """
+        with self._dotLock:
+            conn = self._dots.get(resolver)
+            if conn is None:
+                conn = self._dots[resolver] = DotConnection(resolver ,
+                    self.port , self.tlsContext , self.tlsServerName ,
+                    self.defTO)
+        return conn
+
+    def close(self):
+        """
+        Close any persistent TLS connections
+        """
+        with self._dotLock:
+            conns = self._dots.values()
+            self._dots = {}
+        for conn in conns:
+            conn.close()
+
+    def _cacheHit(self , res , callback=None , **kwargs):
+        """
+        Handle a result found in the cache.  This can be overridden
+        in a subclass to handle callbacks
+        """
+        return res
+
+    def _cacheResult(self , res):
+        """
+        Add a result to the cache, if we have one
+        """
+        if self.cache is not None and res is not None:
+            self.cache.put(res)
+
     def _parseResolvConf(self):
         """
         Parse the resolv.conf file for nameservers
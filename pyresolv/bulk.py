@@ -0,0 +1,186 @@
+"""
+Bulk decoding of raw DNS responses into columnar arrays.  This is meant
+for offline analysis of large numbers of archived responses where
+building a DnsResult for every message is too slow.
+
+If NumPy is installed, the columns will be numpy arrays.  Otherwise
+they will be array.array instances.
+"""
+
+from . import *
+from array import array
+import struct , mmap
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = ['BulkBatch' , 'decodeBulk' , 'iterFramed']
+
+HDR = struct.Struct('!HHHHHH')
+QTAIL = struct.Struct('!HH')
+RRHDR = struct.Struct('!HHLH')
+LEN16 = struct.Struct('!H')
+IPV4 = struct.Struct('!L')
+
+class BulkBatch(object):
+    """
+    A batch of decoded messages stored as columns.  All of the per
+    message columns have the same length, which is len(batch).
+
+    Per message columns:
+        valid       1 if the message was decoded, 0 if it was malformed
+        id          The message id
+        rcode       The response code (see the RCD_ constants)
+        qtype       The question type
+        ancount     The number of records in the answer section
+        minTTL      The lowest TTL in the answer section, -1 if there
+                    are no answers
+
+    Per answer record columns (all the same length):
+        ansMsg      The index of the message in this batch the record
+                    belongs to
+        ansType     The record type
+        ansTTL      The record TTL
+
+    IPv4 answer columns (all the same length):
+        ipv4Msg     The index of the message in this batch the address
+                    belongs to
+        ipv4        The address packed into an unsigned 32 bit int
+    """
+    # Column names and their array typecodes
+    msgCols = (('valid' , 'B') , ('id' , 'H') , ('rcode' , 'B') ,
+        ('qtype' , 'H') , ('ancount' , 'H') , ('minTTL' , 'l'))
+    ansCols = (('ansMsg' , 'L') , ('ansType' , 'H') , ('ansTTL' , 'L'))
+    ipv4Cols = (('ipv4Msg' , 'L') , ('ipv4' , 'L'))
+
+    def __init__(self):
+        for name , tc in self.msgCols + self.ansCols + self.ipv4Cols:
+            setattr(self , name , array(tc))
+
+    def __len__(self):
+        return len(self.id)
+
+    def toNumpy(self):
+        """
+        Convert all the columns to numpy arrays in place.  This is done
+        automatically by decodeBulk() when numpy is available
+        """
+        if numpy is None:
+            raise ImportError('numpy is not installed')
+        for name , tc in self.msgCols + self.ansCols + self.ipv4Cols:
+            col = getattr(self , name)
+            if isinstance(col , array):
+                setattr(self , name , numpy.frombuffer(col , dtype=tc))
+        return self
+
+def decodeBulk(messages , batchSize=65536 , useNumpy=True):
+    """
+    A generator that decodes raw DNS messages and yields BulkBatch
+    objects of up to batchSize messages each.
+
+    messages:iter|str   Either an iterable of raw DNS messages or a
+                        single buffer (str or mmap) of messages that
+                        are each prefixed with a 2 byte length, as
+                        they would be on a TCP connection
+    batchSize:int       The number of messages in each batch
+    useNumpy:bool       Convert the columns to numpy arrays if numpy
+                        is available
+    """
+    if isinstance(messages , (basestring , mmap.mmap)):
+        messages = iterFramed(messages)
+    batch = BulkBatch()
+    for msg in messages:
+        _decodeOne(batch , msg)
+        if len(batch) >= batchSize:
+            yield _finish(batch , useNumpy)
+            batch = BulkBatch()
+    if len(batch):
+        yield _finish(batch , useNumpy)
+
+def iterFramed(buf):
+    """
+    A generator that splits a buffer of 2 byte length prefixed DNS
+    messages into the individual messages.  A truncated message at
+    the end of the buffer is ignored.
+
+    buf:str|mmap        The buffer of messages
+    """
+    off = 0
+    size = len(buf)
+    while off + 2 <= size:
+        l = LEN16.unpack_from(buf , off)[0]
+        off += 2
+        if off + l > size:
+            break
+        yield buf[off:off + l]
+        off += l
+
+def _finish(batch , useNumpy):
+    if useNumpy and numpy is not None:
+        batch.toNumpy()
+    return batch
+
+def _skipName(buf , off):
+    """
+    Returns the offset just past the name at off without decoding it
+    """
+    while True:
+        l = ord(buf[off])
+        if l & 0xC0 == 0xC0:
+            return off + 2
+        if l == 0:
+            return off + 1
+        off += l + 1
+
+def _decodeOne(batch , msg):
+    """
+    Decode a single message and append it to the batch columns
+    """
+    idx = len(batch)
+    nAns = len(batch.ansMsg)
+    nIp = len(batch.ipv4)
+    try:
+        mid , flags , qdcount , ancount , nscount , arcount = \
+            HDR.unpack_from(msg , 0)
+        off = HDR.size
+        qtype = 0
+        for i in xrange(qdcount):
+            off = _skipName(msg , off)
+            if i == 0:
+                qtype = QTAIL.unpack_from(msg , off)[0]
+            off += QTAIL.size
+        minTTL = -1
+        for i in xrange(ancount):
+            off = _skipName(msg , off)
+            rtype , rclass , ttl , rdlen = RRHDR.unpack_from(msg , off)
+            off += RRHDR.size
+            if off + rdlen > len(msg):
+                raise IndexError('rdata overruns the message')
+            batch.ansMsg.append(idx)
+            batch.ansType.append(rtype)
+            batch.ansTTL.append(ttl)
+            if minTTL < 0 or ttl < minTTL:
+                minTTL = ttl
+            if rtype == QT_A and rdlen == 4:
+                batch.ipv4Msg.append(idx)
+                batch.ipv4.append(IPV4.unpack_from(msg , off)[0])
+            off += rdlen
+    except (struct.error , IndexError , TypeError):
+        # Malformed message.  Roll back any answers we added and record
+        # it as invalid
+        for col in (batch.ansMsg , batch.ansType , batch.ansTTL):
+            del col[nAns:]
+        for col in (batch.ipv4Msg , batch.ipv4):
+            del col[nIp:]
+        for name , tc in batch.msgCols:
+            getattr(batch , name).append(0)
+        batch.minTTL[-1] = -1
+        return
+    batch.valid.append(1)
+    batch.id.append(mid)
+    batch.rcode.append(flags & 15)
+    batch.qtype.append(qtype)
+    batch.ancount.append(ancount)
+    batch.minTTL.append(minTTL)
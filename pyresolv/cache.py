@@ -0,0 +1,588 @@
+"""
+TTL based answer caches for the DNS clients, with support for saving
+and loading a binary snapshot of the cache for fast warm restarts.
+DnsCache is local to a process while SharedDnsCache is shared between
+processes through shared memory.
+"""
+
+import dnsreqres as drr
+from errors import ResError
+from . import *
+from collections import OrderedDict
+import struct , time , mmap , os , threading , multiprocessing , fcntl , zlib , \
+    copy
+
+# Snapshot file layout.  The file starts with a header of:
+#   magic:4s , version:B
+# followed by any number of entries of:
+#   expires:d , qtype:H , qclass:H , nameLen:H , dataLen:H
+#   name:nameLen bytes , data:dataLen bytes (the raw wire message)
+SNAP_MAGIC = 'PYRC'
+SNAP_VERSION = 1
+SNAP_HDR = struct.Struct('!4sB')
+SNAP_ENTRY = struct.Struct('!dHHHH')
+
+class DnsCache(object):
+    """
+    A thread-safe cache of dnsreqres.DnsResult objects keyed on
+    (qname , qtype , qclass).  Each entry expires based on the lowest
+    TTL in the answer section of the result (or the SOA for negative
+    answers).
+
+    The cache can be written to disk with save() and read back in
+    with load().  Loading uses mmap and only reads the entry headers
+    up front.  The actual DNS messages are not parsed until they are
+    requested with get().
+    """
+    # Whether load() leaves the entries in the snapshot mmap
+    _lazyLoad = True
+
+    def __init__(self , maxEntries=10000 , negTTL=60 , maxTTL=86400):
+        """
+        maxEntries:int      The maximum number of entries to hold.  The
+                            oldest entries are evicted first when this
+                            is reached
+        negTTL:int          The TTL to use for negative answers (NXDOMAIN
+                            or no data) when there is no SOA in the
+                            authority section
+        maxTTL:int          The maximum time, in seconds, an entry will
+                            be cached regardless of its TTL
+        """
+        self.maxEntries = int(maxEntries)
+        self.negTTL = int(negTTL)
+        self.maxTTL = int(maxTTL)
+        # Map of key -> [expires , DnsResult|None , (mmap , offset , len)]
+        self._store = OrderedDict()
+        self._lock = threading.Lock()
+        # Any mmaps currently backing lazily loaded entries
+        self._maps = []
+
+    def __len__(self):
+        return len(self._store)
+
+    def get(self , qname , qtype=QT_A , qclass=CL_IN):
+        """
+        Return the cached DnsResult for the query or None if it
+        isn't in the cache or has expired.  The record TTLs in the
+        returned result are lowered to the time the entry has left in
+        the cache, so results that are cached again or passed on don't
+        outlive the original.  Note that the id and rawBuf of the
+        returned result are those of the original response.
+
+        qname:str       The query, such as "google.com"
+        qtype:int       One of the QT_ constants
+        qclass:int      One of the CL_ constants
+        """
+        entry = self.getEntry(qname , qtype , qclass)
+        if entry is None:
+            return None
+        return _capTTLs(entry[0] , int(entry[1] - time.time()))
+
+    def getEntry(self , qname , qtype=QT_A , qclass=CL_IN):
+        """
+        The same as get(), but returns a tuple of (DnsResult , expires)
+        where expires is the absolute time the entry expires at, or
+        None if it isn't cached.  The TTLs in the result are the
+        original ones, not adjusted for the time spent in the cache
+        """
+        key = self._getKey(qname , qtype , qclass)
+        with self._lock:
+            entry = self._store.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self._store[key]
+                return None
+            if entry[1] is None:
+                # This was lazily loaded from a snapshot, parse it now
+                mm , off , l = entry[2]
+                try:
+                    entry[1] = drr.DnsResult(mm[off:off + l])
+                except ResError:
+                    del self._store[key]
+                    return None
+                entry[2] = None
+            return (entry[1] , entry[0])
+
+    def put(self , res):
+        """
+        Add a DnsResult to the cache.  Results that are truncated or
+        that have an error code other than NXDOMAIN are not cached.
+        Returns True if the result was cached.
+
+        res:DnsResult       The result to cache
+        """
+        ttl = self._getTTL(res)
+        if ttl <= 0:
+            return False
+        key = self._getKey(res.qname , res.qtype , res.qclass)
+        self._set(key , time.time() + ttl , res , None)
+        return True
+
+    def remove(self , qname , qtype=QT_A , qclass=CL_IN):
+        """
+        Remove an entry from the cache
+        """
+        key = self._getKey(qname , qtype , qclass)
+        with self._lock:
+            self._store.pop(key , None)
+
+    def clear(self):
+        """
+        Empty the cache and release any snapshot mappings
+        """
+        with self._lock:
+            self._store.clear()
+            self._closeMaps()
+
+    def expire(self):
+        """
+        Remove all the expired entries from the cache
+        """
+        now = time.time()
+        with self._lock:
+            for key , entry in self._store.items():
+                if entry[0] <= now:
+                    del self._store[key]
+
+    def save(self , path):
+        """
+        Write a snapshot of all the unexpired entries to a file.  The
+        snapshot is written to a temp file which is then renamed over
+        the path so a reader never sees a partial file.  Returns the
+        number of entries written
+
+        path:str        The path to the snapshot file
+        """
+        tmpPath = '%s.%d.tmp' % (path , os.getpid())
+        count = 0
+        fh = open(tmpPath , 'wb')
+        try:
+            fh.write(SNAP_HDR.pack(SNAP_MAGIC , SNAP_VERSION))
+            for (qname , qtype , qclass) , expires , data in \
+                    self._iterEntries():
+                fh.write(SNAP_ENTRY.pack(expires , qtype , qclass ,
+                    len(qname) , len(data)))
+                fh.write(qname)
+                fh.write(data)
+                count += 1
+        finally:
+            fh.close()
+        os.rename(tmpPath , path)
+        return count
+
+    def load(self , path):
+        """
+        Load a snapshot written by save() into the cache.  Only the
+        entry headers are read here, the messages themselves are parsed
+        on first access.  Expired entries are discarded.  Returns the
+        number of entries loaded
+
+        path:str        The path to the snapshot file
+        """
+        fh = open(path , 'rb')
+        try:
+            if os.fstat(fh.fileno()).st_size < SNAP_HDR.size:
+                raise ResError('Invalid cache snapshot: %s' % path)
+            mm = mmap.mmap(fh.fileno() , 0 , access=mmap.ACCESS_READ)
+        finally:
+            fh.close()
+        magic , version = SNAP_HDR.unpack_from(mm , 0)
+        if magic != SNAP_MAGIC or version != SNAP_VERSION:
+            mm.close()
+            raise ResError('Invalid cache snapshot: %s' % path)
+        now = time.time()
+        size = len(mm)
+        off = SNAP_HDR.size
+        count = 0
+        while off + SNAP_ENTRY.size <= size:
+            expires , qtype , qclass , nLen , dLen = \
+                SNAP_ENTRY.unpack_from(mm , off)
+            off += SNAP_ENTRY.size
+            if off + nLen + dLen > size:
+                # Truncated entry, stop here
+                break
+            if expires > now:
+                qname = mm[off:off + nLen]
+                if self._loadEntry((qname , qtype , qclass) , expires ,
+                        mm , off + nLen , dLen):
+                    count += 1
+            off += nLen + dLen
+        if count and self._lazyLoad:
+            with self._lock:
+                self._maps.append(mm)
+        else:
+            mm.close()
+        return count
+
+    def close(self):
+        """
+        Alias for clear()
+        """
+        self.clear()
+
+    def _set(self , key , expires , res , loc):
+        with self._lock:
+            self._store.pop(key , None)
+            self._store[key] = [expires , res , loc]
+            while len(self._store) > self.maxEntries:
+                self._store.popitem(last=False)
+
+    def _iterEntries(self):
+        """
+        Yields a tuple of (key , expires , rawData) for every unexpired
+        entry in the cache
+        """
+        now = time.time()
+        with self._lock:
+            entries = self._store.items()
+        for key , entry in entries:
+            if entry[0] <= now:
+                continue
+            if entry[1] is not None:
+                data = entry[1].rawBuf
+            else:
+                mm , off , l = entry[2]
+                data = mm[off:off + l]
+            yield (key , entry[0] , data)
+
+    def _loadEntry(self , key , expires , mm , off , l):
+        """
+        Add an entry from a snapshot.  The entry is left in the mmap to
+        be parsed on first access
+        """
+        self._set(key , expires , None , (mm , off , l))
+        return True
+
+    def _closeMaps(self):
+        for mm in self._maps:
+            try:
+                mm.close()
+            except:
+                pass
+        self._maps = []
+
+    def _getKey(self , qname , qtype , qclass):
+        return (qname.lower().rstrip('.') , int(qtype) , int(qclass))
+
+    def _getTTL(self , res):
+        """
+        Figure out how long a result should be cached for
+        """
+        if res.tc or res.rcode not in (RCD_OK , RCD_NAME_ERR):
+            return 0
+        if res.rcode == RCD_OK and res.answers:
+            ttl = min([a[3] for a in res.answers])
+        else:
+            # Negative answer, use the SOA in the authority section
+            # if we have it
+            ttl = self.negTTL
+            for rr in res.authority:
+                if rr[1] == QT_SOA:
+                    ttl = min(rr[3] , rr[4][6])
+                    break
+        return min(ttl , self.maxTTL)
+
+def _capTTLs(res , ttl):
+    """
+    Returns res with all its record TTLs capped at ttl.  The TTL of
+    an OPT record holds flags, so it is left alone.  A copy is only
+    made if any of them need to change
+    """
+    ttl = max(ttl , 0)
+    sections = (res.answers , res.authority , res.additional)
+    if not [rr for l in sections for rr in l
+            if rr[3] > ttl and rr[1] != QT_OPT]:
+        return res
+    ret = copy.copy(res)
+    ret.answers , ret.authority , ret.additional = [
+        [rr if rr[1] == QT_OPT else rr[:3] + (min(rr[3] , ttl) ,) + rr[4:]
+            for rr in l]
+        for l in sections]
+    return ret
+
+# Shared cache layout.  The mapping starts with a header of:
+#   magic:4s , version:B , nSlots:L , slotSize:L
+# padded out to SHM_HDR_SIZE, followed by nSlots slots of slotSize
+# bytes.  Each slot starts with:
+#   seq:L , expires:d , hash:L , qtype:H , qclass:H , nameLen:H ,
+#   dataLen:H
+# followed by the name and the raw wire message.  seq is odd while a
+# writer is updating the slot and expires is 0 for an empty slot.
+SHM_MAGIC = 'PYSC'
+SHM_VERSION = 1
+SHM_HDR = struct.Struct('!4sBLL')
+SHM_HDR_SIZE = 64
+SLOT_HDR = struct.Struct('!LdLHHHH')
+SEQ = struct.Struct('!L')
+
+class SharedDnsCache(DnsCache):
+    """
+    A DnsCache that keeps its entries in a fixed size hash table in
+    shared memory so that every process using it sees the same cache.
+    It can be used anywhere a DnsCache can.
+
+    With no path, an anonymous shared mapping is used.  Create the
+    cache before forking (for example in a pre-fork server's master
+    process) and every child will share it.  With a path, the table
+    lives in that file and any process can attach to it.
+
+    Reads don't take a lock; each slot has a sequence number that is
+    checked before and after the slot is copied.  Writes take a single
+    write lock.
+    """
+    _lazyLoad = False
+
+    def __init__(self , path=None , nSlots=65536 , slotSize=1024 ,
+            probes=8 , negTTL=60 , maxTTL=86400):
+        """
+        path:str        An optional file to back the table with.  If it
+                        exists and holds a table, that table is used
+                        and nSlots/slotSize are ignored
+        nSlots:int      The number of slots in the table
+        slotSize:int    The size of each slot in bytes.  Messages that
+                        don't fit in a slot are not cached
+        probes:int      The number of slots to check for each key
+        negTTL:int      See DnsCache
+        maxTTL:int      See DnsCache
+        """
+        DnsCache.__init__(self , nSlots , negTTL , maxTTL)
+        self.path = path
+        self.probes = int(probes)
+        size = SHM_HDR_SIZE + nSlots * slotSize
+        if path is None:
+            self._fh = None
+            self._mm = mmap.mmap(-1 , size)
+            # Created before the fork, so every child shares it
+            self._wLock = multiprocessing.Lock()
+            self._initHeader(nSlots , slotSize)
+        else:
+            self._fh = open(path , 'a+b')
+            # lockf() locks are per process, so they don't keep the
+            # threads of this process out of each other's way
+            self._wLock = threading.Lock()
+            fcntl.lockf(self._fh , fcntl.LOCK_EX)
+            try:
+                if os.fstat(self._fh.fileno()).st_size < SHM_HDR_SIZE:
+                    self._fh.truncate(size)
+                    self._mm = mmap.mmap(self._fh.fileno() , size)
+                    self._initHeader(nSlots , slotSize)
+                else:
+                    self._mm = mmap.mmap(self._fh.fileno() , 0)
+            finally:
+                fcntl.lockf(self._fh , fcntl.LOCK_UN)
+        magic , version , self.nSlots , self.slotSize = \
+            SHM_HDR.unpack_from(self._mm , 0)
+        if magic != SHM_MAGIC or version != SHM_VERSION:
+            raise ResError('Invalid shared cache: %s' % path)
+        self.maxEntries = self.nSlots
+        self._maxData = self.slotSize - SLOT_HDR.size
+        # Per process cache of parsed results: slot -> (seq , DnsResult)
+        self._parsed = {}
+
+    def __len__(self):
+        now = time.time()
+        count = 0
+        for i in xrange(self.nSlots):
+            expires = SLOT_HDR.unpack_from(self._mm , self._slotOff(i))[1]
+            if expires > now:
+                count += 1
+        return count
+
+    def getEntry(self , qname , qtype=QT_A , qclass=CL_IN):
+        key = self._getKey(qname , qtype , qclass)
+        h = self._hash(key)
+        now = time.time()
+        for i in self._probe(h):
+            slot = self._readSlot(i)
+            if slot is None:
+                continue
+            seq , expires , sHash , sType , sClass , name , data = slot
+            if (sHash != h or sType != key[1] or sClass != key[2] or
+                    name != key[0]):
+                continue
+            if expires <= now:
+                return None
+            cached = self._parsed.get(i)
+            if cached is not None and cached[0] == seq:
+                return (cached[1] , expires)
+            try:
+                res = drr.DnsResult(data)
+            except ResError:
+                return None
+            self._parsed[i] = (seq , res)
+            return (res , expires)
+        return None
+
+    def put(self , res):
+        ttl = self._getTTL(res)
+        if ttl <= 0:
+            return False
+        key = self._getKey(res.qname , res.qtype , res.qclass)
+        return self._storeSlot(key , time.time() + ttl , res.rawBuf)
+
+    def remove(self , qname , qtype=QT_A , qclass=CL_IN):
+        key = self._getKey(qname , qtype , qclass)
+        h = self._hash(key)
+        self._acquire()
+        try:
+            for i in self._probe(h):
+                slot = self._readSlot(i)
+                if slot is not None and slot[2] == h and \
+                        slot[3:6] == (key[1] , key[2] , key[0]):
+                    self._clearSlot(i)
+        finally:
+            self._release()
+
+    def clear(self):
+        self._acquire()
+        try:
+            for i in xrange(self.nSlots):
+                self._clearSlot(i)
+        finally:
+            self._release()
+        self._parsed = {}
+
+    def expire(self):
+        now = time.time()
+        self._acquire()
+        try:
+            for i in xrange(self.nSlots):
+                expires = SLOT_HDR.unpack_from(self._mm ,
+                    self._slotOff(i))[1]
+                if expires and expires <= now:
+                    self._clearSlot(i)
+        finally:
+            self._release()
+
+    def close(self):
+        """
+        Unmap the table.  The cache can't be used after this
+        """
+        self._mm.close()
+        if self._fh is not None:
+            self._fh.close()
+
+    def _iterEntries(self):
+        now = time.time()
+        for i in xrange(self.nSlots):
+            slot = self._readSlot(i)
+            if slot is None or slot[1] <= now:
+                continue
+            seq , expires , sHash , sType , sClass , name , data = slot
+            yield ((name , sType , sClass) , expires , data)
+
+    def _loadEntry(self , key , expires , mm , off , l):
+        return self._storeSlot(key , expires , mm[off:off + l])
+
+    def _initHeader(self , nSlots , slotSize):
+        SHM_HDR.pack_into(self._mm , 0 , SHM_MAGIC , SHM_VERSION , nSlots ,
+            slotSize)
+
+    def _acquire(self):
+        self._wLock.acquire()
+        if self._fh is not None:
+            try:
+                fcntl.lockf(self._fh , fcntl.LOCK_EX)
+            except:
+                self._wLock.release()
+                raise
+
+    def _release(self):
+        try:
+            if self._fh is not None:
+                fcntl.lockf(self._fh , fcntl.LOCK_UN)
+        finally:
+            self._wLock.release()
+
+    def _hash(self , key):
+        return zlib.crc32('%s|%d|%d' % key) & 0xFFFFFFFF
+
+    def _probe(self , h):
+        start = h % self.nSlots
+        return [(start + i) % self.nSlots for i in xrange(self.probes)]
+
+    def _slotOff(self , i):
+        return SHM_HDR_SIZE + i * self.slotSize
+
+    def _readSlot(self , i):
+        """
+        Returns (seq , expires , hash , qtype , qclass , name , data) for
+        a slot, or None if it is empty or being written to
+        """
+        off = self._slotOff(i)
+        mm = self._mm
+        seq = SEQ.unpack_from(mm , off)[0]
+        if seq & 1:
+            return None
+        raw = mm[off:off + self.slotSize]
+        if SEQ.unpack_from(mm , off)[0] != seq:
+            # A writer got in while we were copying
+            return None
+        seq , expires , h , qtype , qclass , nLen , dLen = \
+            SLOT_HDR.unpack_from(raw , 0)
+        start = SLOT_HDR.size
+        if not expires or start + nLen + dLen > self.slotSize:
+            # Empty slot
+            return None
+        return (seq , expires , h , qtype , qclass ,
+            raw[start:start + nLen] , raw[start + nLen:start + nLen + dLen])
+
+    def _clearSlot(self , i):
+        self._writeSlot(i , 0 , 0 , 0 , 0 , '' , '')
+
+    def _writeSlot(self , i , expires , h , qtype , qclass , name , data):
+        """
+        Write a slot.  This must be called with the write lock held.
+        The sequence number is made odd while writing and then bumped
+        to the next even number so readers can detect the change
+        """
+        off = self._slotOff(i)
+        mm = self._mm
+        seq = SEQ.unpack_from(mm , off)[0]
+        seq = ((seq | 1) + 2) & 0xFFFFFFFF
+        SEQ.pack_into(mm , off , seq)
+        start = off + SLOT_HDR.size
+        mm[start:start + len(name) + len(data)] = name + data
+        SLOT_HDR.pack_into(mm , off , seq , expires , h , qtype , qclass ,
+            len(name) , len(data))
+        SEQ.pack_into(mm , off , (seq + 1) & 0xFFFFFFFF)
+
+    def _storeSlot(self , key , expires , data):
+        """
+        Write an entry into the table.  Returns False if it doesn't fit
+        """
+        name , qtype , qclass = key
+        if len(name) + len(data) > self._maxData:
+            return False
+        h = self._hash(key)
+        self._acquire()
+        try:
+            # Use the slot already holding this key, else an empty or
+            # expired one, else the one closest to expiring
+            now = time.time()
+            target = None
+            oldest = None
+            oldestExp = 0
+            for i in self._probe(h):
+                seq , sExp , sHash , sType , sClass , nLen , dLen = \
+                    SLOT_HDR.unpack_from(self._mm , self._slotOff(i))
+                if sExp and sHash == h and (sType , sClass) == (qtype ,
+                        qclass):
+                    start = self._slotOff(i) + SLOT_HDR.size
+                    if self._mm[start:start + nLen] == name:
+                        target = i
+                        break
+                if sExp <= now:
+                    if target is None:
+                        target = i
+                elif oldest is None or sExp < oldestExp:
+                    oldest = i
+                    oldestExp = sExp
+            if target is None:
+                target = oldest
+            self._writeSlot(target , expires , h , qtype , qclass , name ,
+                data)
+        finally:
+            self._release()
+        return True
@@ -0,0 +1,250 @@
+"""
+Streaming readers for DNS messages stored in packet captures (pcap and
+pcapng) or in files of 2 byte length prefixed messages, as they would
+appear on a TCP connection.
+
+The files are memory mapped and the messages are yielded one at a time
+so memory use stays flat no matter how large the capture is.  The
+output of iterCapture() can also be fed straight to bulk.decodeBulk().
+"""
+
+import dnsreqres as drr
+from bulk import iterFramed
+from errors import ResError
+import struct , mmap
+
+__all__ = ['iterCapture' , 'iterResults' , 'iterPcap' , 'iterPcapng' ,
+    'openCapture']
+
+# Link layer types
+LT_NULL = 0
+LT_ETHERNET = 1
+LT_RAW = 101
+LT_RAW_ALT = 12
+LT_LINUX_SLL = 113
+LT_LINUX_SLL2 = 276
+LT_IPV4 = 228
+LT_IPV6 = 229
+
+# Ethertypes
+ET_IPV4 = 0x0800
+ET_IPV6 = 0x86DD
+ET_VLAN = (0x8100 , 0x88A8 , 0x9100)
+
+# IP protocols
+IPP_TCP = 6
+IPP_UDP = 17
+# IPv6 extension headers we will skip over
+IPV6_EXT = (0 , 43 , 60)
+
+# pcapng block types
+PNG_SHB = 0x0A0D0D0A
+PNG_IDB = 1
+PNG_SPB = 3
+PNG_EPB = 6
+
+def openCapture(path):
+    """
+    Memory map a capture file read-only and return the mmap.  An empty
+    file returns an empty string
+
+    path:str        The path to the file
+    """
+    fh = open(path , 'rb')
+    try:
+        try:
+            return mmap.mmap(fh.fileno() , 0 , access=mmap.ACCESS_READ)
+        except ValueError:
+            # Can't map an empty file
+            return ''
+    finally:
+        fh.close()
+
+def iterCapture(path , ports=(53,)):
+    """
+    A generator that yields the raw DNS messages in a capture file.
+    The format is detected automatically: pcap, pcapng or a stream of
+    2 byte length prefixed messages.
+
+    Only UDP datagrams and TCP segments to or from one of the ports are
+    considered.  TCP streams are not reassembled, so only segments
+    that carry complete messages are yielded.
+
+    path:str        The path to the capture file
+    ports:list[int] The ports that carry DNS traffic
+    """
+    mm = openCapture(path)
+    try:
+        magic = mm[:4]
+        if magic in ('\xa1\xb2\xc3\xd4' , '\xd4\xc3\xb2\xa1' ,
+                '\xa1\xb2\x3c\x4d' , '\x4d\x3c\xb2\xa1'):
+            gen = iterPcap(mm , ports)
+        elif magic == '\x0a\x0d\x0d\x0a':
+            gen = iterPcapng(mm , ports)
+        else:
+            gen = iterFramed(mm)
+        for msg in gen:
+            yield msg
+    finally:
+        if isinstance(mm , mmap.mmap):
+            mm.close()
+
+def iterResults(path , ports=(53,) , skipInvalid=True):
+    """
+    A generator that yields a dnsreqres.DnsResult for each message in
+    a capture file.  See iterCapture() for the options.  Queries in
+    the capture are parsed as well; check DnsResult.qr to tell them
+    apart from responses.
+
+    skipInvalid:bool    Skip messages that fail to parse instead of
+                        raising a ResError
+    """
+    for msg in iterCapture(path , ports):
+        try:
+            yield drr.DnsResult(msg)
+        except ResError:
+            if not skipInvalid:
+                raise
+
+def iterPcap(buf , ports=(53,)):
+    """
+    A generator that yields the DNS payloads in a classic pcap buffer
+
+    buf:str|mmap    The capture file contents
+    ports:list[int] The ports that carry DNS traffic
+    """
+    if buf[:4] in ('\xa1\xb2\xc3\xd4' , '\xa1\xb2\x3c\x4d'):
+        end = '>'
+    else:
+        end = '<'
+    linkType = struct.unpack_from(end + 'L' , buf , 20)[0] & 0xFFFF
+    recHdr = struct.Struct(end + 'LLLL')
+    off = 24
+    size = len(buf)
+    while off + recHdr.size <= size:
+        sec , frac , capLen , origLen = recHdr.unpack_from(buf , off)
+        off += recHdr.size
+        if off + capLen > size:
+            break
+        for msg in _getPayloads(buf , off , off + capLen , linkType ,
+                ports):
+            yield msg
+        off += capLen
+
+def iterPcapng(buf , ports=(53,)):
+    """
+    A generator that yields the DNS payloads in a pcapng buffer
+
+    buf:str|mmap    The capture file contents
+    ports:list[int] The ports that carry DNS traffic
+    """
+    off = 0
+    size = len(buf)
+    end = '<'
+    linkTypes = []
+    while off + 12 <= size:
+        btype = struct.unpack_from(end + 'L' , buf , off)[0]
+        if btype == PNG_SHB:
+            # A new section, which may change the byte order
+            if buf[off+8:off+12] == '\x1a\x2b\x3c\x4d':
+                end = '>'
+            else:
+                end = '<'
+            linkTypes = []
+        blen = struct.unpack_from(end + 'L' , buf , off + 4)[0]
+        if blen < 12 or off + blen > size:
+            break
+        body = off + 8
+        if btype == PNG_IDB:
+            linkTypes.append(struct.unpack_from(end + 'H' , buf , body)[0])
+        elif btype == PNG_EPB:
+            ifId , tsHi , tsLo , capLen , origLen = struct.unpack_from(
+                end + 'LLLLL' , buf , body)
+            if ifId < len(linkTypes):
+                start = body + 20
+                for msg in _getPayloads(buf , start , start + capLen ,
+                        linkTypes[ifId] , ports):
+                    yield msg
+        elif btype == PNG_SPB and linkTypes:
+            # The captured length is whatever fits in the block
+            start = body + 4
+            for msg in _getPayloads(buf , start , off + blen - 4 ,
+                    linkTypes[0] , ports):
+                yield msg
+        off += blen
+
+def _getPayloads(buf , off , end , linkType , ports):
+    """
+    Strip the link, IP and transport headers from a frame and return
+    a list of DNS messages found in it
+    """
+    try:
+        ipOff = _stripLink(buf , off , linkType)
+        if ipOff is None:
+            return []
+        return _stripIp(buf , ipOff , end , ports)
+    except (struct.error , IndexError):
+        # Truncated frame
+        return []
+
+def _stripLink(buf , off , linkType):
+    """
+    Returns the offset of the IP header or None if the frame isn't IP
+    """
+    if linkType == LT_ETHERNET:
+        etype = struct.unpack_from('!H' , buf , off + 12)[0]
+        off += 14
+        while etype in ET_VLAN:
+            etype = struct.unpack_from('!H' , buf , off + 2)[0]
+            off += 4
+    elif linkType == LT_LINUX_SLL:
+        etype = struct.unpack_from('!H' , buf , off + 14)[0]
+        off += 16
+    elif linkType == LT_LINUX_SLL2:
+        etype = struct.unpack_from('!H' , buf , off)[0]
+        off += 20
+    elif linkType == LT_NULL:
+        # The address family is in host byte order of the capturing
+        # machine, so just check the IP version nibble
+        off += 4
+        etype = None
+    elif linkType in (LT_RAW , LT_RAW_ALT , LT_IPV4 , LT_IPV6):
+        etype = None
+    else:
+        return None
+    if etype is not None and etype not in (ET_IPV4 , ET_IPV6):
+        return None
+    return off
+
+def _stripIp(buf , off , end , ports):
+    ver = ord(buf[off]) >> 4
+    if ver == 4:
+        ihl = (ord(buf[off]) & 15) * 4
+        totLen , fragOff , proto = struct.unpack_from('!H2xHxB' , buf ,
+            off + 2)
+        if fragOff & 0x3FFF:
+            # Fragments are not reassembled
+            return []
+        end = min(end , off + totLen)
+        off += ihl
+    elif ver == 6:
+        plen , proto = struct.unpack_from('!HB' , buf , off + 4)
+        end = min(end , off + 40 + plen)
+        off += 40
+        while proto in IPV6_EXT:
+            proto = ord(buf[off])
+            off += (ord(buf[off+1]) + 1) * 8
+    else:
+        return []
+    if proto == IPP_UDP:
+        sport , dport , ulen = struct.unpack_from('!HHH' , buf , off)
+        if sport not in ports and dport not in ports:
+            return []
+        return [buf[off + 8:min(end , off + ulen)]]
+    elif proto == IPP_TCP:
+        sport , dport , doff = struct.unpack_from('!HHxxxxxxxxB' , buf ,
+            off)
+        if sport not in ports and dport not in ports:
+            return []
+        return list(iterFramed(buf[off + (doff >> 4) * 4:end]))
+    return []
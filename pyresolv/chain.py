@@ -0,0 +1,108 @@
+"""
+Following CNAME and DNAME chains.  See DNS.resolve().
+"""
+
+from errors import ResError
+from . import *
+
+__all__ = ['ResolveResult' , 'MAX_CHAIN']
+
+# The most CNAME/DNAME links to follow before giving up
+MAX_CHAIN = 16
+
+class ResolveResult(object):
+    """
+    The result of resolving a name through any CNAME and DNAME links.
+
+    name:str            The name that was looked up
+    qtype:int           The query type
+    target:str          The canonical name at the end of the chain
+    answers:list        The records of qtype at the target, in the
+                        same (name , qtype , qclass , ttl , data) form
+                        as DnsResult.answers
+    chain:list          The CNAME and DNAME records that were followed,
+                        in order
+    rcode:int           The rcode for the target.  This is
+                        RCD_NAME_ERR if the chain ends at a name that
+                        doesn't exist
+    ttl:int             The lowest TTL in the chain and the answers
+    queries:int         The number of queries that went to the network
+    """
+    def __init__(self , name , qtype):
+        self.name = name
+        self.qtype = qtype
+        self.target = name
+        self.answers = []
+        self.chain = []
+        self.rcode = RCD_OK
+        self.queries = 0
+        self._seen = set([name.lower()])
+
+    @property
+    def ttl(self):
+        ttls = [rec[3] for rec in self.chain + self.answers]
+        return min(ttls) if ttls else 0
+
+    def __repr__(self):
+        return '<ResolveResult %s -> %s: %d links, %d answers>' % (
+            self.name , self.target , len(self.chain) , len(self.answers))
+
+    def addLink(self , rec , target):
+        """
+        Add a CNAME or DNAME record to the chain and move the target on
+        to where it points.  Raises a ResError on a loop or a chain that
+        is too long
+        """
+        key = target.lower()
+        if key in self._seen:
+            raise ResError('CNAME/DNAME loop resolving %s at %s' % (
+                self.name , target))
+        if len(self.chain) >= MAX_CHAIN:
+            raise ResError('CNAME/DNAME chain for %s is longer than %d' % (
+                self.name , MAX_CHAIN))
+        self._seen.add(key)
+        self.chain.append(rec)
+        self.target = target
+
+def walkChain(result , records):
+    """
+    Follow every link for the result's current target that is in a list
+    of records.  Sets the answers if the records of the query type are
+    found at the end.  Returns a list of the links that were followed
+    """
+    links = []
+    while True:
+        cur = result.target.lower()
+        answers = [rec for rec in records if rec[0].lower() == cur and
+            rec[1] == result.qtype]
+        if answers:
+            result.answers = answers
+            return links
+        # A DNAME comes first.  Any CNAME for a name under it is just
+        # synthesized from it, and the DNAME covers more names when it
+        # is cached
+        link = _findDname(cur , result.target , records)
+        if link is None:
+            for rec in records:
+                if rec[1] == QT_CNAME and rec[0].lower() == cur:
+                    link = (rec , rec[4])
+                    break
+        if link is None:
+            return links
+        result.addLink(*link)
+        links.append(link[0])
+
+def _findDname(cur , name , records):
+    """
+    Returns (record , new target) for a DNAME record that covers the
+    name, or None
+    """
+    for rec in records:
+        owner = rec[0].lower()
+        if rec[1] == QT_DNAME and cur.endswith('.' + owner):
+            target = '%s.%s' % (name[:-len(owner) - 1] , rec[4])
+            if len(target) > 253:
+                raise ResError('DNAME substitution of %s by %s is too '
+                    'long' % (name , rec[4]))
+            return rec , target
+    return None
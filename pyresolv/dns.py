@@ -5,9 +5,13 @@ Synchronous DNS client library
 import dnsreqres as drr
 from basedns import BaseDNS
 from errors import TimeoutError , ResError , ReqError
+from idalloc import SocketIdPool
+from dnsbl import DnsblResult
+from chain import ResolveResult , walkChain
+from mmsg import sendMany , MmsgReceiver
 # Get all the constants in init
 from . import *
-import select
+import select , time , heapq , struct , socket
 
 class DNS(BaseDNS):
     """
@@ -20,6 +24,9 @@ class DNS(BaseDNS):
         result will be an Exception object if an exception occurs 
         for that lookup.
 
+        All of the requests are sent at once, using sendmmsg() where
+        available, and the results are read as they come in.
+
         batchlist:list[list|DnsRequest]     This should be a list
                         of either dsnreqres.DnsRequest objects or
                         a list/tuple of (query , qtype).  If you want
@@ -30,22 +37,316 @@ class DNS(BaseDNS):
         if timeout is None:
             timeout = self.defTO
         todo = []
-        ret = []
         # Loop through the list and add DnsRequest objects to the
         # todo list, converting normal requests as necessary
         for item in batchList:
             if not isinstance(item , drr.DnsRequest):
                 item = drr.DnsRequest(*item)
             todo.append(item)
-        for req in todo:
-            res = None
-            try:
-                res = self._doLookup(req , timeout)
-            except Exception , e:
-                res = e
-            ret.append((req , res))
+        return zip(todo , self._runBatch(todo , [timeout] * len(todo)))
+
+    def resolve(self , name , qtype=QT_A , timeout=None , qclass=CL_IN):
+        """
+        Look up a name, following any CNAME and DNAME links to the
+        records of qtype.  Every link that is already in an answer is
+        used without another query, so when the resolver returns the
+        whole chain this costs a single query.  Follow up queries are
+        only sent for the links that are missing.
+
+        If this has a cache, each link and the final records are also
+        cached on their own, by their own TTLs, so names whose chains
+        share links don't have to resolve those links again.
+
+        Returns a chain.ResolveResult.  Raises a ResError on a loop or
+        a chain longer than chain.MAX_CHAIN links
+
+        name:str        The name to look up
+        qtype:int       The type of the records wanted at the end of
+                        the chain
+        timeout:float   The timeout for each query
+        """
+        result = ResolveResult(name.rstrip('.') , qtype)
+        while True:
+            res = self._getCachedLink(result.target , qtype , qclass)
+            # Only what came back from a lookup is cached again, so
+            # the links already in the cache keep their expiry times
+            fromLookup = res is None
+            if fromLookup:
+                res = self.lookup(result.target , qtype , timeout , qclass)
+                result.queries += 1
+            start = result.target
+            links = walkChain(result , res.answers)
+            if fromLookup:
+                for rec in links:
+                    self._cacheRecords(rec[0] , rec[1] , qclass , [rec])
+            if result.answers:
+                if fromLookup and result.target.lower() != start.lower():
+                    self._cacheRecords(result.target , qtype , qclass ,
+                        result.answers)
+                break
+            if res.rcode != RCD_OK or not links or \
+                    self._isNoData(res , result.target):
+                # Either the chain ends here or the resolver already
+                # followed it to a name without any qtype records
+                result.rcode = res.rcode
+                break
+        return result
+
+    def _getCachedLink(self , name , qtype , qclass):
+        """
+        Returns a cached result for the name, or for a CNAME or DNAME
+        link that covers it, or None
+        """
+        if self.cache is None:
+            return None
+        res = self.cache.get(name , qtype , qclass)
+        if res is not None:
+            return res
+        res = self.cache.get(name , QT_CNAME , qclass)
+        if res is not None and res.answers:
+            return res
+        labels = name.split('.')
+        for i in xrange(1 , len(labels)):
+            res = self.cache.get('.'.join(labels[i:]) , QT_DNAME , qclass)
+            if res is not None and res.answers:
+                return res
+        return None
+
+    def _cacheRecords(self , name , qtype , qclass , records):
+        """
+        Cache a set of records on their own, as if they were the answer
+        to a query for (name , qtype)
+        """
+        if self.cache is None:
+            return
+        b = drr.DnsMessageBuilder(qr=1 , ra=1)
+        try:
+            b.addQuestion(name , qtype , qclass)
+            for rname , rtype , rclass , ttl , data in records:
+                b.addAnswer(rname , rtype , ttl , data , rclass)
+            res = drr.DnsResult(b.getBuf())
+        except (ReqError , ResError , TypeError , ValueError ,
+                struct.error) , e:
+            # Record data we can't encode again, just don't cache it
+            return
+        self._cacheResult(res)
+
+    def _isNoData(self , res , name):
+        """
+        Returns True if res has an SOA in the authority section for a
+        zone that holds name, meaning name has no records of the type
+        """
+        name = name.lower()
+        for owner , rtype , rclass , ttl , data in res.authority:
+            owner = owner.lower()
+            if rtype == QT_SOA and (not owner or name == owner or
+                    name.endswith('.' + owner)):
+                return True
+        return False
+
+    def dnsbl(self , ip , zones , timeout=None):
+        """
+        Check an IP against a list of DNSBL zones.  The A and TXT
+        queries for every zone are sent at once, so the whole check
+        takes a single round trip.  Returns a dict of zone ->
+        dnsbl.DnsblResult, or an exception instance if the lookup in
+        that zone failed.
+
+        If this has a cache, the answers are cached by their TTLs, so
+        repeat checks of the same (ip , zone) don't hit the network.
+
+        ip:str                  The IPv4 or IPv6 address to check
+        zones:list[str]|dict    The DNSBL zones.  This can also be a
+                                dict of zone -> timeout to give some
+                                zones their own timeouts
+        timeout:float           The timeout for the zones that don't
+                                have their own
+        """
+        return self.dnsblMany([ip] , zones , timeout)[0][1]
+
+    def dnsblMany(self , ips , zones , timeout=None):
+        """
+        Check a list of IPs against a list of DNSBL zones, all in one
+        batch.  Returns a list of (ip , {zone: DnsblResult}) in the
+        same order as the IPs.  See dnsbl() for the options
+        """
+        if timeout is None:
+            timeout = self.defTO
+        if isinstance(zones , dict):
+            zones = [(zone , timeout if zto is None else zto)
+                for zone , zto in zones.iteritems()]
+        else:
+            zones = [(zone , timeout) for zone in zones]
+        todo = []
+        timeouts = []
+        for ip in ips:
+            # Only reverse the IP once for all the zones
+            rev = self._reverseName(ip)
+            for zone , zto in zones:
+                name = '%s.%s' % (rev , zone.rstrip('.'))
+                todo.append(drr.DnsRequest(name , QT_A))
+                todo.append(drr.DnsRequest(name , QT_TXT))
+                timeouts.extend((zto , zto))
+        results = iter(self._runBatch(todo , timeouts))
+        ret = []
+        for ip in ips:
+            found = {}
+            for zone , zto in zones:
+                aRes = results.next()
+                txtRes = results.next()
+                if isinstance(aRes , Exception):
+                    found[zone] = aRes
+                    continue
+                if isinstance(txtRes , Exception):
+                    txtRes = None
+                found[zone] = DnsblResult(ip , zone , aRes , txtRes)
+            ret.append((ip , found))
         return ret
 
+    def _runBatch(self , todo , timeouts):
+        """
+        Send all the requests at once and return a list of the results,
+        or exception instances, in the same order.  Each request has its
+        own timeout in the timeouts list
+        """
+        results = [None] * len(todo)
+        if self.cache is not None:
+            for i , req in enumerate(todo):
+                results[i] = self.cache.get(req.qname , req.qtype ,
+                    req.qclass)
+        if self.useTls:
+            self._tlsQuery(todo , results , timeouts)
+            return results
+        pools = self._getPools()
+        # Map of (fd , id) -> index in todo
+        pending = {}
+        # Map of fd -> [sock , [packets to send]]
+        outgoing = {}
+        for i , req in enumerate(todo):
+            if results[i] is not None:
+                continue
+            for pool in pools:
+                sock , id = pool.alloc()
+                if sock is None:
+                    results[i] = ResError('Too many queries in flight')
+                    break
+                req.setId(id)
+                fd = sock.fileno()
+                outgoing.setdefault(fd , [sock , []])[1].append(
+                    req.getBuf())
+                pending[(fd , id)] = i
+        try:
+            self._sendAndWait(outgoing , pending , results , timeouts)
+        finally:
+            for pool in pools:
+                pool.close()
+        for i , res in enumerate(results):
+            if res is None:
+                results[i] = TimeoutError('Hit timeout of %f when '
+                    'querying for %s' % (timeouts[i] , todo[i].qname))
+        return results
+
+    def _tlsQuery(self , todo , results , timeouts):
+        """
+        Pipeline all the requests that don't have a result yet over the
+        TLS connection to the first resolver.  If we aren't just using
+        the first resolver, anything that fails is retried on the next
+        one
+        """
+        idx = [i for i , res in enumerate(results) if res is None]
+        for resolver in self.resolvers:
+            if not idx:
+                break
+            conn = self._getDot(resolver)
+            answers = conn.queryMany([todo[i] for i in idx] ,
+                [timeouts[i] for i in idx])
+            failed = []
+            for i , res in zip(idx , answers):
+                results[i] = res
+                if isinstance(res , Exception):
+                    failed.append(i)
+                else:
+                    self._cacheResult(res)
+            idx = failed
+            if self.useFirst: break
+
+    def _getPools(self):
+        """
+        Returns a list of SocketIdPools, one per resolver in use
+        """
+        pools = []
+        for resolver in self.resolvers:
+            factory = lambda r=resolver: self._getSock(r , self.defTO)
+            pools.append(SocketIdPool(factory))
+            if self.useFirst: break
+        return pools
+
+    def _sendAndWait(self , outgoing , pending , results , timeouts):
+        """
+        Send all the outgoing packets and fill in the results as the
+        answers come in, until everything is answered or has hit its
+        timeout
+        """
+        mask = select.EPOLLIN | select.EPOLLPRI
+        p = select.poll()
+        fdMap = {}
+        start = time.time()
+        waiting = set([i for i in pending.itervalues()
+            if results[i] is None])
+        for fd , (sock , packets) in outgoing.iteritems():
+            p.register(fd , mask)
+            fdMap[fd] = sock
+            try:
+                sendMany(sock , packets , self.useMmsg)
+            except socket.error , e:
+                self._failSock(fd , e , p , pending , results , waiting)
+        receiver = MmsgReceiver(useMmsg=self.useMmsg)
+        # A heap of (deadline , index) for timing out requests
+        deadlines = [(start + timeouts[i] , i) for i in waiting]
+        heapq.heapify(deadlines)
+        while waiting:
+            now = time.time()
+            while deadlines and (deadlines[0][0] <= now or
+                    deadlines[0][1] not in waiting):
+                # Timed out or already answered
+                waiting.discard(heapq.heappop(deadlines)[1])
+            if not waiting:
+                break
+            for fd , event in p.poll((deadlines[0][0] - now) * 1000):
+                try:
+                    packets = receiver.recv(fdMap[fd])
+                except socket.error , e:
+                    self._failSock(fd , e , p , pending , results , waiting)
+                    continue
+                for packet in packets:
+                    try:
+                        res = drr.DnsResult(packet)
+                    except ResError:
+                        continue
+                    i = pending.pop((fd , res.id) , None)
+                    if i not in waiting:
+                        # Unknown id, already answered by another
+                        # resolver or already timed out
+                        continue
+                    results[i] = res
+                    self._cacheResult(res)
+                    waiting.discard(i)
+
+    def _failSock(self , fd , err , p , pending , results , waiting):
+        """
+        Stop using a socket that had an error.  The error becomes the
+        result of every request that was only waiting on that socket
+        """
+        p.unregister(fd)
+        failed = set()
+        for key in [key for key in pending if key[0] == fd]:
+            failed.add(pending.pop(key))
+        # Requests also sent to another resolver can still be answered
+        failed.difference_update(pending.itervalues())
+        for i in failed & waiting:
+            results[i] = err
+            waiting.discard(i)
+
     def _doLookup(self , req , timeout , callback=None , **kwargs):
         """
         Performs the actual lookup(s), handling all the socket 
@@ -53,6 +354,12 @@ class DNS(BaseDNS):
         """
         ret = None
         timeout = float(timeout)
+        if self.useTls:
+            results = [None]
+            self._tlsQuery([req] , results , [timeout])
+            if isinstance(results[0] , Exception):
+                raise results[0]
+            return results[0]
         mask = select.EPOLLIN | select.EPOLLPRI
         fdMap = {}
         p = select.poll()
@@ -66,7 +373,7 @@ class DNS(BaseDNS):
             p.register(fd , mask)
             fdMap[fd] = sock
             if self.useFirst: break
-        res = p.poll(timeout)
+        res = p.poll(timeout * 1000)
         if res:
             # Get the first result in the list
             fd , event = res[0]
@@ -76,7 +383,7 @@ class DNS(BaseDNS):
         # Close all the sockets
         for s in fdMap.itervalues():
             s.close()
-        if ret.id != req.id:
+        if ret is not None and ret.id != req.id:
             # Make sure the ids match
             raise ResError('Result id, %d, does not match ' % ret.id +
                 'request id, %d. Possible forgery' % req.id)
@@ -89,4 +396,5 @@ class DNS(BaseDNS):
                 tried = self.resolvers
             raise TimeoutError('Hit timeout of %f when querying %r' % 
                 (timeout , tried))
+        self._cacheResult(ret)
         return ret
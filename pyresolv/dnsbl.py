@@ -0,0 +1,69 @@
+"""
+DNS blocklist (DNSBL) results.  See DNS.dnsbl() and DNS.dnsblMany()
+for doing the lookups.
+"""
+
+from . import *
+
+__all__ = ['DnsblResult']
+
+def _joinCharStrs(data):
+    """
+    Join the character-strings in raw TXT rdata into a single string
+    """
+    parts = []
+    off = 0
+    while off < len(data):
+        l = ord(data[off])
+        parts.append(data[off + 1:off + 1 + l])
+        off += l + 1
+    return ''.join(parts)
+
+class DnsblResult(object):
+    """
+    The result of checking one IP against one DNSBL zone.  This is built
+    from the A and TXT answers for the reversed IP in the zone.
+
+    ip:str              The IP address that was checked
+    zone:str            The DNSBL zone
+    listed:bool         Whether the IP is listed in the zone
+    addrs:list[str]     The 127.0.0.0/8 return addresses
+    codes:list[int]     The last octet of each return address, which
+                        is the list specific return code
+    reasons:list[str]   The TXT reasons, if the zone gave any
+    rcode:int           The rcode of the A lookup
+    ttl:int             The lowest TTL of the answers
+    """
+    def __init__(self , ip , zone , aRes , txtRes=None):
+        """
+        ip:str                  The IP address that was checked
+        zone:str                The DNSBL zone
+        aRes:DnsResult          The result of the A lookup
+        txtRes:DnsResult        The result of the TXT lookup, or None
+                                if it failed
+        """
+        self.ip = ip
+        self.zone = zone
+        self.rcode = aRes.rcode
+        self.addrs = [data for name , qtype , qclass , ttl , data in
+            aRes.answers if qtype == QT_A and data.startswith('127.')]
+        self.codes = [int(addr.rsplit('.' , 1)[1]) for addr in self.addrs]
+        # Zones use 127.255.255.0/24 to report errors, such as queries
+        # coming from a blocked public resolver, rather than a listing
+        self.listed = bool([addr for addr in self.addrs
+            if not addr.startswith('127.255.255.')])
+        self.reasons = []
+        ttls = [ttl for name , qtype , qclass , ttl , data in aRes.answers]
+        if self.addrs and txtRes is not None:
+            for name , qtype , qclass , ttl , data in txtRes.answers:
+                if qtype == QT_TXT:
+                    self.reasons.append(_joinCharStrs(data))
+                    ttls.append(ttl)
+        self.ttl = min(ttls) if ttls else 0
+
+    def __nonzero__(self):
+        return self.listed
+
+    def __repr__(self):
+        return '<DnsblResult %s in %s: listed=%s codes=%r>' % (self.ip ,
+            self.zone , self.listed , self.codes)
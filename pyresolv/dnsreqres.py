@@ -1,11 +1,12 @@
 #!/usr/bin/env python
 
-import struct , random
+import struct , socket
 from errors import ReqError , ResError
-from cStringIO import StringIO
+from idalloc import randomId
 from . import *
 
-__all__ = ['DnsRequest' , 'DnsResult']
+__all__ = ['DnsRequest' , 'DnsResult' , 'DnsMessageBuilder' ,
+    'registerDecoder']
 
 """
 For more information on this, see RFC 1035
@@ -14,6 +15,18 @@ To give credit where credit is due, some of the code here is based on
 the pydns library:  http://pydns.sourceforge.net
 """
 
+# The largest possible DNS message
+MAX_MSG_SIZE = 65535
+
+HEADER = struct.Struct('!HHHHHH')
+TYPE_CLASS = struct.Struct('!HH')
+RR_HDR = struct.Struct('!HHLH')
+LEN16 = struct.Struct('!H')
+SOA_TAIL = struct.Struct('!LLLLL')
+SRV_HDR = struct.Struct('!HHH')
+DS_HDR = struct.Struct('!HBB')
+OPT_HDR = struct.Struct('!HH')
+
 class DnsRequest(object):
     """
     The DNS Request class supports any/all options as defined in RFC 1035
@@ -36,7 +49,6 @@ class DnsRequest(object):
                         one of the OPC_ constants
         rd:int          A flag (0 or 1) whether recursion is desired
         """
-        self.buf = StringIO()
         self.qname = qname
         self.qtype = int(qtype)
         self.qclass = int(qclass)
@@ -54,67 +66,306 @@ class DnsRequest(object):
         self.nscount = 0
         self.arcount = 0
         # Process the above to generate a buffer
-        self._addHeader()
-        self._addQuestion()
+        self._buildBuf()
     
     def __str__(self):
         return self.getBuf()
 
-    def __del__(self):
-        try:
-            self.close()
-        except:
-            pass
-        
     def getBuffer(self):
         return self.getBuf()
     
     def getBuf(self):
-        return self.buf.getvalue()
+        return self._buf
 
     def close(self):
         """
-        Destroys the buffer for cleanup
+        This is a no-op now that the message is kept as an immutable
+        string.  It is kept for backwards compatibility
         """
-        try:
-            self.buf.close()
-        except:
-            pass
+        pass
     
+    def setId(self , id):
+        """
+        Change the id of the request, updating the packet as well
+        """
+        self.id = int(id)
+        self._buf = LEN16.pack(self.id) + self._buf[2:]
+
     def _getId(self):
-        return random.randint(0 , 65535)
-    
-    def _get16bit(self , n):
-        return struct.pack('!H' , n)
+        return randomId()
     
-    def _getName(self , name):
-        ret = ''
+    def _buildBuf(self):
+        b = DnsMessageBuilder(self.id , qr=self.qr , opcode=self.opcode ,
+            aa=self.aa , tc=self.tc , rd=self.rd , ra=self.ra ,
+            rcode=self.rcode , maxSize=512 , compress=False)
+        b.addQuestion(self.qname , self.qtype , self.qclass)
+        self._buf = b.getBuf()
+
+class DnsMessageBuilder(object):
+    """
+    Builds a complete DNS message, including multiple questions, answer,
+    authority and additional sections and an EDNS OPT record.  Names
+    are compressed (RFC 1035 4.1.4) and everything is packed into a
+    single buffer, which starts out at 512 bytes and doubles as needed.
+
+    The sections must be added in order: questions, answers, authority
+    and then additional records.  Example:
+
+        b = DnsMessageBuilder(1234 , qr=1 , aa=1)
+        b.addQuestion('www.example.com' , QT_A)
+        b.addAnswer('www.example.com' , QT_CNAME , 300 , 'example.com')
+        b.addAnswer('example.com' , QT_A , 300 , '192.0.2.1')
+        b.addEdns(4096)
+        packet = b.getBuf()
+
+    The rdata for the answer/authority/additional records is given in
+    the same form that DnsResult returns it in for the types that have
+    an encoder in RDATA_ENCODERS.  For any other type, pass the raw
+    rdata string.
+    """
+    # Section indexes
+    QUESTION = 0
+    ANSWER = 1
+    AUTHORITY = 2
+    ADDITIONAL = 3
+
+    def __init__(self , id=None , qr=0 , opcode=OPC_QUERY , aa=0 , tc=0 ,
+            rd=1 , ra=0 , rcode=RCD_OK , maxSize=MAX_MSG_SIZE ,
+            compress=True):
+        """
+        See RFC 1035 for the header flags.
+
+        id:int          The message id.  A random one is chosen if
+                        not set
+        maxSize:int     The maximum size of the message in bytes.  A
+                        ReqError is raised if it is exceeded.  Use
+                        512 for plain UDP without EDNS
+        compress:bool   Whether to compress names
+        """
+        if id is None:
+            id = randomId()
+        self.id = int(id)
+        self.flags = ((qr & 1) << 15 | (opcode & 15) << 11 |
+            (aa & 1) << 10 | (tc & 1) << 9 | (rd & 1) << 8 |
+            (ra & 1) << 7 | (rcode & 15))
+        self.maxSize = int(maxSize)
+        self.compress = compress
+        self._buf = bytearray(min(512 , self.maxSize))
+        # Start just past the header
+        self._off = 12
+        self._counts = [0 , 0 , 0 , 0]
+        self._section = self.QUESTION
+        # Map of lowercased name suffix -> offset in the buffer
+        self._names = {}
+
+    def __len__(self):
+        return self._off
+
+    def addQuestion(self , qname , qtype=QT_A , qclass=CL_IN):
+        """
+        Add a question to the message
+        """
+        self._setSection(self.QUESTION)
+        self._putName(qname)
+        self._pack(TYPE_CLASS , int(qtype) , int(qclass))
+
+    def addAnswer(self , name , qtype , ttl , rdata , qclass=CL_IN):
+        """
+        Add a record to the answer section
+        """
+        self._addRR(self.ANSWER , name , qtype , qclass , ttl , rdata)
+
+    def addAuthority(self , name , qtype , ttl , rdata , qclass=CL_IN):
+        """
+        Add a record to the authority section
+        """
+        self._addRR(self.AUTHORITY , name , qtype , qclass , ttl , rdata)
+
+    def addAdditional(self , name , qtype , ttl , rdata , qclass=CL_IN):
+        """
+        Add a record to the additional section
+        """
+        self._addRR(self.ADDITIONAL , name , qtype , qclass , ttl , rdata)
+
+    def addEdns(self , payload=4096 , extRcode=0 , version=0 , do=0 ,
+            options=()):
+        """
+        Add an EDNS OPT pseudo record (RFC 6891) to the additional
+        section
+
+        payload:int             The UDP payload size we can handle
+        extRcode:int            The upper 8 bits of the extended rcode
+        version:int             The EDNS version
+        do:int                  The DNSSEC OK bit
+        options:list[tuple]     A list of (optionCode , optionData)
+        """
+        ttl = ((extRcode & 0xFF) << 24 | (version & 0xFF) << 16 |
+            (do & 1) << 15)
+        self._addRR(self.ADDITIONAL , '' , QT_OPT , payload , ttl ,
+            list(options))
+
+    def getBuf(self):
+        """
+        Returns the message as a string
+        """
+        HEADER.pack_into(self._buf , 0 , self.id , self.flags ,
+            *self._counts)
+        return str(self._buf[:self._off])
+
+    def _setSection(self , section):
+        if section < self._section:
+            raise ReqError('Message sections must be added in order')
+        self._section = section
+        self._counts[section] += 1
+
+    def _addRR(self , section , name , qtype , qclass , ttl , rdata):
+        qtype = int(qtype)
+        self._setSection(section)
+        self._putName(name)
+        self._pack(RR_HDR , qtype , int(qclass) , int(ttl) , 0)
+        # Write the rdata, then go back and fill in its length
+        lenOff = self._off - 2
+        enc = RDATA_ENCODERS.get(qtype)
+        if enc is None or (isinstance(rdata , str) and
+                qtype not in STR_RDATA_TYPES):
+            self._write(rdata)
+        else:
+            enc(self , rdata)
+        LEN16.pack_into(self._buf , lenOff , self._off - lenOff - 2)
+
+    def _reserve(self , end):
+        """
+        Make sure the buffer can hold end bytes
+        """
+        if end > self.maxSize:
+            raise ReqError('Message exceeds the maximum size of %d' %
+                self.maxSize)
+        size = len(self._buf)
+        if end > size:
+            while size < end:
+                size *= 2
+            self._buf.extend(bytearray(min(size , self.maxSize) -
+                len(self._buf)))
+
+    def _write(self , data):
+        end = self._off + len(data)
+        self._reserve(end)
+        self._buf[self._off:end] = data
+        self._off = end
+
+    def _pack(self , st , *args):
+        self._reserve(self._off + st.size)
+        st.pack_into(self._buf , self._off , *args)
+        self._off += st.size
+
+    def _putName(self , name , compress=True):
+        # Encode first, so the lengths and the compression offsets are
+        # in bytes
+        labels = []
         for part in name.split('.'):
-            if part:
+            if isinstance(part , unicode):
                 part = part.encode('utf8')
-                l = len(part)
-                if l > 63:
-                    raise ReqError('The length of part, %s, ' % part +
-                        'is limited to 63 characters')
-                ret += chr(l) + part
-        ret += '\0'
-        return ret
-    
-    def _addHeader(self):
-        self.buf.write(self._get16bit(self.id))
-        self.buf.write(self._get16bit((self.qr & 1) << 15 | 
-                (self.opcode & 15) << 11 | (self.aa & 1) << 10 |
-                (self.tc & 1) << 9 | (self.rd & 1) << 8 |
-                (self.ra & 1) << 7 | (self.z & 7) << 4 | (self.rcode & 15)))
-        self.buf.write(self._get16bit(self.qdcount))
-        self.buf.write(self._get16bit(self.ancount))
-        self.buf.write(self._get16bit(self.nscount))
-        self.buf.write(self._get16bit(self.arcount))
-        
-    def _addQuestion(self):
-        self.buf.write(self._getName(self.qname))
-        self.buf.write(self._get16bit(self.qtype))
-        self.buf.write(self._get16bit(self.qclass))
+            if len(part) > 63:
+                raise ReqError('The length of part, %s, ' % part +
+                    'is limited to 63 bytes')
+            if part:
+                labels.append(part)
+        ptr = None
+        if self.compress:
+            # Find the longest suffix we have already written
+            lower = [part.lower() for part in labels]
+            for i in xrange(len(labels)):
+                ptr = self._names.get('.'.join(lower[i:]))
+                if ptr is not None:
+                    break
+            if ptr is None or not compress:
+                i = len(labels)
+                ptr = None
+            # Record where each of the new suffixes will start
+            off = self._off
+            for j in xrange(i):
+                if off < 0x4000:
+                    self._names.setdefault('.'.join(lower[j:]) , off)
+                off += len(labels[j]) + 1
+            labels = labels[:i]
+        parts = []
+        for part in labels:
+            parts.append(chr(len(part)))
+            parts.append(part)
+        if ptr is None:
+            parts.append('\0')
+        else:
+            parts.append(LEN16.pack(0xC000 | ptr))
+        self._write(''.join(parts))
+
+    def _putCharStr(self , s):
+        if len(s) > 255:
+            raise ReqError('Character strings are limited to 255 bytes')
+        self._write(chr(len(s)) + s)
+
+    def _putNameRec(self , name):
+        self._putName(name)
+
+    def _putNameNoComp(self , name):
+        # RFC 3597 says only the original RFC 1035 types may be
+        # compressed in rdata
+        self._putName(name , False)
+
+    def _putA(self , ip):
+        self._write(socket.inet_pton(socket.AF_INET , ip))
+
+    def _putAAAA(self , ip):
+        self._write(socket.inet_pton(socket.AF_INET6 , ip))
+
+    def _putMX(self , rdata):
+        pref , dom = rdata
+        self._pack(LEN16 , pref)
+        self._putName(dom)
+
+    def _putSOA(self , rdata):
+        mname , rname , serial , refresh , retry , expire , minimum = rdata
+        self._putName(mname)
+        self._putName(rname)
+        self._pack(SOA_TAIL , serial , refresh , retry , expire , minimum)
+
+    def _putMINFO(self , rdata):
+        rmailbx , emailbx = rdata
+        self._putName(rmailbx)
+        self._putName(emailbx)
+
+    def _putHINFO(self , rdata):
+        cpu , os = rdata
+        self._putCharStr(cpu)
+        self._putCharStr(os)
+
+    def _putTXT(self , data):
+        if isinstance(data , str):
+            # Raw rdata, as returned by DnsResult
+            self._write(data)
+        else:
+            for s in data:
+                self._putCharStr(s)
+
+    def _putSRV(self , rdata):
+        prio , weight , port , target = rdata
+        self._pack(SRV_HDR , prio , weight , port)
+        self._putName(target , False)
+
+    def _putCAA(self , rdata):
+        flags , tag , value = rdata
+        self._write(chr(flags))
+        self._putCharStr(tag)
+        self._write(value)
+
+    def _putDS(self , rdata):
+        keyTag , alg , digestType , digest = rdata
+        self._pack(DS_HDR , keyTag , alg , digestType)
+        self._write(digest)
+
+    def _putOPT(self , options):
+        for code , data in options:
+            self._pack(OPT_HDR , code , len(data))
+            self._write(data)
 
 class DnsResult(object):
     """
@@ -163,6 +414,20 @@ class DnsResult(object):
              retry:int ,     # Retry time
              expire:int ,    # Expire time 
              minTTL:int)     # Min TTL, or these days, negative cache time
+        SRV: (priority:int , weight:int , port:int , target:str)
+        NAPTR: (order:int , pref:int , flags:str , services:str ,
+                regexp:str , replacement:str)
+        CAA: (flags:int , tag:str , value:str)
+        DS: (keyTag:int , algorithm:int , digestType:int , digest:str)
+        DNSKEY: (flags:int , protocol:int , algorithm:int , key:str)
+        RRSIG: (typeCovered:int , algorithm:int , labels:int ,
+                origTTL:int , expiration:int , inception:int ,
+                keyTag:int , signer:str , signature:str)
+        SVCB, HTTPS: (priority:int , target:str , params:dict)
+        OPT: A list of (optionCode:int , optionData:str)
+
+    Any type without a decoder in RDATA_DECODERS is returned as the
+    raw rdata string.  See registerDecoder() to add your own.
     """
     def __init__(self , rawBuf):
         self.rawBuf = rawBuf
@@ -194,8 +459,10 @@ class DnsResult(object):
         # Convenience Error stuff
         self.errno = self.rcode
         self.error = self._getErrStr()
-        if self.rcode == RCD_OK:
-            # Get the answer
+        if self.rcode in (RCD_OK , RCD_NAME_ERR):
+            # Get the answer.  A name error can still carry the CNAME
+            # chain that led to the missing name and the SOA for its
+            # negative TTL
             try:
                 self._extractData(self.ancount , self.answers)
                 self._extractData(self.nscount , self.authority)
@@ -258,11 +525,11 @@ class DnsResult(object):
     def _getName(self , offset=-1 , data=None , retOffset=False):
         qname = ''
         cp = offset
-        if data and cp == -1:
+        if data is not None and cp == -1:
             cp = 0
         while True:
             i = 0
-            if data:
+            if data is not None:
                 i = ord(data[cp:cp+1])
                 cp += 1
             elif cp > -1:
@@ -273,7 +540,7 @@ class DnsResult(object):
             if i & 0xC0 == 0xC0:
                 # Pointer, get the next byte
                 j = 0
-                if data:
+                if data is not None:
                     j = ord(data[cp:cp+1])
                     cp += 1
                 elif cp > -1:
@@ -298,7 +565,7 @@ class DnsResult(object):
                     return qname
             else:
                 chunk = ''
-                if data:
+                if data is not None:
                     chunk = data[cp:cp+i]
                     cp += i
                 elif cp > -1:
@@ -311,40 +578,154 @@ class DnsResult(object):
                 else:
                     qname = chunk
                     
+    def _getCharStr(self , data , off):
+        """
+        Returns a tuple of (<character-string> , newOffset)
+        """
+        l = ord(data[off])
+        off += 1
+        return (data[off:off+l] , off + l)
+
+    def _getNameRec(self , data):
+        return self._getName(data=data)
+
+    def _getMX(self , data):
+        pref = self._get16bit(data[:2])
+        dom = self._getName(data=data[2:])
+        return (pref , dom)
+
+    def _getA(self , data):
+        return socket.inet_ntop(socket.AF_INET , data)
+
+    def _getAAAA(self , data):
+        return socket.inet_ntop(socket.AF_INET6 , data)
+
+    def _getRaw(self , data):
+        return data
+
+    def _getMINFO(self , data):
+        rmailbx , off = self._getName(data=data , retOffset=True)
+        emailbx = self._getName(off , data)
+        return (rmailbx , emailbx)
+
+    def _getHINFO(self , data):
+        cpu , off = self._getCharStr(data , 0)
+        os , off = self._getCharStr(data , off)
+        return (cpu , os)
+
+    def _getSRV(self , data):
+        prio , weight , port = struct.unpack('!HHH' , data[:6])
+        target = self._getName(data=data[6:])
+        return (prio , weight , port , target)
+
+    def _getNAPTR(self , data):
+        order , pref = struct.unpack('!HH' , data[:4])
+        flags , off = self._getCharStr(data , 4)
+        services , off = self._getCharStr(data , off)
+        regexp , off = self._getCharStr(data , off)
+        replacement = self._getName(off , data)
+        return (order , pref , flags , services , regexp , replacement)
+
+    def _getCAA(self , data):
+        flags = ord(data[0])
+        tag , off = self._getCharStr(data , 1)
+        return (flags , tag , data[off:])
+
+    def _getDS(self , data):
+        keyTag , alg , digestType = struct.unpack('!HBB' , data[:4])
+        return (keyTag , alg , digestType , data[4:])
+
+    def _getDNSKEY(self , data):
+        flags , proto , alg = struct.unpack('!HBB' , data[:4])
+        return (flags , proto , alg , data[4:])
+
+    def _getRRSIG(self , data):
+        (typeCovered , alg , labels , origTTL , expiration , inception ,
+            keyTag) = struct.unpack('!HBBLLLH' , data[:18])
+        signer , off = self._getName(18 , data , True)
+        return (typeCovered , alg , labels , origTTL , expiration ,
+            inception , keyTag , signer , data[off:])
+
+    def _getTypeBitmap(self , data , off):
+        """
+        Decode an NSEC style type bitmap into a list of qtypes
+        """
+        types = []
+        while off < len(data):
+            window = ord(data[off])
+            l = ord(data[off+1])
+            off += 2
+            for i , c in enumerate(data[off:off+l]):
+                c = ord(c)
+                for bit in xrange(8):
+                    if c & (0x80 >> bit):
+                        types.append(window * 256 + i * 8 + bit)
+            off += l
+        return types
+
+    def _getNSEC(self , data):
+        nextName , off = self._getName(data=data , retOffset=True)
+        return (nextName , self._getTypeBitmap(data , off))
+
+    def _getOPT(self , data):
+        """
+        Returns a list of (optionCode , optionData) for an EDNS OPT
+        record.  Note that the class and TTL of the OPT record hold
+        the UDP payload size and the extended rcode and flags
+        """
+        opts = []
+        off = 0
+        while off + 4 <= len(data):
+            code , l = struct.unpack('!HH' , data[off:off+4])
+            off += 4
+            opts.append((code , data[off:off+l]))
+            off += l
+        return opts
+
+    def _getSVCB(self , data):
+        """
+        Returns (priority , target , params) where params is a dict of
+        SvcParamKey to value.  The alpn, port and ip hint values are
+        decoded and everything else is left as raw bytes
+        """
+        prio = self._get16bit(data[:2])
+        target , off = self._getName(2 , data , True)
+        params = {}
+        while off + 4 <= len(data):
+            key , l = struct.unpack('!HH' , data[off:off+4])
+            off += 4
+            val = data[off:off+l]
+            off += l
+            if key == SVC_ALPN:
+                alpn = []
+                vo = 0
+                while vo < len(val):
+                    proto , vo = self._getCharStr(val , vo)
+                    alpn.append(proto)
+                val = alpn
+            elif key == SVC_PORT:
+                val = self._get16bit(val)
+            elif key == SVC_IPV4HINT:
+                val = [socket.inet_ntop(socket.AF_INET , val[i:i+4])
+                    for i in xrange(0 , len(val) , 4)]
+            elif key == SVC_IPV6HINT:
+                val = [socket.inet_ntop(socket.AF_INET6 , val[i:i+16])
+                    for i in xrange(0 , len(val) , 16)]
+            params[key] = val
+        return (prio , target , params)
+
     def _procRawData(self , data , qtype , cl):
-        if qtype in (QT_CNAME , QT_MB , QT_MD , QT_MF , QT_MG , QT_MR ,
-                QT_NS , QT_PTR):
-            return self._getName(data=data)
-        elif qtype == QT_MX:
-            pref = self._get16bit(data[:2])
-            dom = self._getName(data=data[2:])
-            return (pref , dom)
-        elif qtype == QT_A:
-            ip = ''
-            for i , c in enumerate(data):
-                if i < 3:
-                    ip += '%d.' % ord(c)
-                else:
-                    ip += str(ord(c))
-            return ip
-        elif qtype in (QT_NULL , QT_TXT):
+        dec = RDATA_DECODERS.get(qtype)
+        if dec is None or not data:
+            # Unknown type or empty rdata, just hand back the raw rdata
+            return data
+        try:
+            return dec(self , data)
+        except (struct.error , ValueError , IndexError , TypeError ,
+                socket.error):
+            # A malformed record, hand back the raw rdata rather than
+            # failing the whole result
             return data
-        elif qtype == QT_SOA:
-            return self._getSOA(data)
-        elif qtype == QT_MINFO:
-            rmailbx , off = self._getName(data=data , retOffset=True)
-            emailbx = self._getName(off , data)
-            return (rmailbx , emailbx)
-        elif qtype == QT_AAAA:
-            ipv6 = ''
-            for i , c in enumerate(data):
-                ipv6 += hex(ord(c))
-                if i % 2 == 0 and i > 0 and i < 15:
-                    ipv6 += ':'
-            return ipv6
-        else:
-            raise ReqError('Unsupported query type for domain %s: %d' % 
-                    (self.qname , qtype))
         
     def _extractHeader(self):
         self.id = self._get16bit()
@@ -378,6 +759,87 @@ class DnsResult(object):
             data = self._procRawData(rawData , qtype , cl)
             l.append((name , qtype , cl , ttl , data))
 
+# SVCB/HTTPS param keys that are decoded
+SVC_ALPN = 1
+SVC_PORT = 3
+SVC_IPV4HINT = 4
+SVC_IPV6HINT = 6
+
+# Map of qtype -> rdata decoder.  Each decoder is called with the
+# DnsResult instance and the raw rdata.  Types that are not in here
+# are returned as the raw rdata string
+RDATA_DECODERS = {
+    QT_A: DnsResult._getA ,
+    QT_NS: DnsResult._getNameRec ,
+    QT_MD: DnsResult._getNameRec ,
+    QT_MF: DnsResult._getNameRec ,
+    QT_CNAME: DnsResult._getNameRec ,
+    QT_SOA: DnsResult._getSOA ,
+    QT_MB: DnsResult._getNameRec ,
+    QT_MG: DnsResult._getNameRec ,
+    QT_MR: DnsResult._getNameRec ,
+    QT_NULL: DnsResult._getRaw ,
+    QT_PTR: DnsResult._getNameRec ,
+    QT_HINFO: DnsResult._getHINFO ,
+    QT_MINFO: DnsResult._getMINFO ,
+    QT_MX: DnsResult._getMX ,
+    QT_TXT: DnsResult._getRaw ,
+    QT_AAAA: DnsResult._getAAAA ,
+    QT_SRV: DnsResult._getSRV ,
+    QT_NAPTR: DnsResult._getNAPTR ,
+    QT_DNAME: DnsResult._getNameRec ,
+    QT_OPT: DnsResult._getOPT ,
+    QT_DS: DnsResult._getDS ,
+    QT_RRSIG: DnsResult._getRRSIG ,
+    QT_NSEC: DnsResult._getNSEC ,
+    QT_DNSKEY: DnsResult._getDNSKEY ,
+    QT_SVCB: DnsResult._getSVCB ,
+    QT_HTTPS: DnsResult._getSVCB ,
+    QT_CAA: DnsResult._getCAA ,
+}
+
+# Map of qtype -> rdata encoder used by DnsMessageBuilder.  Each encoder
+# is called with the builder and the rdata in the same form that the
+# matching decoder returns it in
+RDATA_ENCODERS = {
+    QT_A: DnsMessageBuilder._putA ,
+    QT_NS: DnsMessageBuilder._putNameRec ,
+    QT_MD: DnsMessageBuilder._putNameRec ,
+    QT_MF: DnsMessageBuilder._putNameRec ,
+    QT_CNAME: DnsMessageBuilder._putNameRec ,
+    QT_SOA: DnsMessageBuilder._putSOA ,
+    QT_MB: DnsMessageBuilder._putNameRec ,
+    QT_MG: DnsMessageBuilder._putNameRec ,
+    QT_MR: DnsMessageBuilder._putNameRec ,
+    QT_PTR: DnsMessageBuilder._putNameRec ,
+    QT_HINFO: DnsMessageBuilder._putHINFO ,
+    QT_MINFO: DnsMessageBuilder._putMINFO ,
+    QT_MX: DnsMessageBuilder._putMX ,
+    QT_TXT: DnsMessageBuilder._putTXT ,
+    QT_AAAA: DnsMessageBuilder._putAAAA ,
+    QT_SRV: DnsMessageBuilder._putSRV ,
+    QT_DNAME: DnsMessageBuilder._putNameNoComp ,
+    QT_OPT: DnsMessageBuilder._putOPT ,
+    QT_DS: DnsMessageBuilder._putDS ,
+    QT_DNSKEY: DnsMessageBuilder._putDS ,
+    QT_CAA: DnsMessageBuilder._putCAA ,
+}
+
+# Types where a plain string is the decoded form of the rdata rather
+# than the raw rdata
+STR_RDATA_TYPES = (QT_A , QT_NS , QT_MD , QT_MF , QT_CNAME , QT_MB ,
+    QT_MG , QT_MR , QT_PTR , QT_TXT , QT_AAAA , QT_DNAME)
+
+def registerDecoder(qtype , func):
+    """
+    Register a decoder for an rdata type, replacing any existing one.
+
+    qtype:int       The record type
+    func:func       A function that takes (DnsResult , rawData) and
+                    returns the decoded answer
+    """
+    RDATA_DECODERS[int(qtype)] = func
+
 def test():
     import socket , time , sys
     domains = (
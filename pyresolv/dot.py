@@ -0,0 +1,385 @@
+"""
+DNS over TLS (RFC 7858) transport.  Each DotConnection keeps a single
+long lived TLS connection to a resolver and pipelines any number of
+length prefixed queries over it.  Responses are matched back to their
+queries by id, so they can arrive in any order.
+"""
+
+import dnsreqres as drr
+from errors import TimeoutError , ResError
+from idalloc import IdAllocator
+from . import *
+import socket , ssl , select , struct , threading , time , os , errno , \
+    logging
+
+__all__ = ['DotConnection' , 'DOT_PORT']
+
+DOT_PORT = 853
+LEN16 = struct.Struct('!H')
+
+class _Waiter(object):
+    """
+    A single outstanding query on a connection
+    """
+    __slots__ = ('id' , 'packet' , 'deadline' , 'event' , 'result' ,
+        'callback' , 'kwargs')
+
+    def __init__(self , id , packet , deadline , callback , kwargs):
+        self.id = id
+        self.packet = packet
+        self.deadline = deadline
+        self.callback = callback
+        self.kwargs = kwargs
+        self.result = None
+        self.event = None
+        if callback is None:
+            self.event = threading.Event()
+
+    def finish(self , result):
+        self.result = result
+        if self.callback is not None:
+            try:
+                self.callback(result , **self.kwargs)
+            except Exception , e:
+                # Don't let a bad callback take down the I/O thread
+                logging.exception('Error in DoT callback: %s' % e)
+        else:
+            self.event.set()
+
+class DotConnection(object):
+    """
+    A persistent, pipelined DNS over TLS connection to one resolver.
+    All the socket I/O happens in a single background thread; queries
+    can be submitted from any thread.
+
+    The connection is opened on the first query and reopened as needed
+    if the resolver closes it.  Where the ssl module supports it (Python
+    3.6+), the TLS session is resumed on reconnect.
+    """
+    def __init__(self , host , port=DOT_PORT , context=None ,
+            serverName=None , connectTimeout=3.0):
+        """
+        host:str            The resolver's IP address
+        port:int            The resolver's port
+        context:SSLContext  The ssl context to use.  If not set, a
+                            default context that verifies the
+                            resolver's certificate is used
+        serverName:str      The name to verify the certificate against
+                            and to send in SNI.  If not set, the
+                            certificate name is not checked
+        connectTimeout:float    The timeout for the TCP connect and the
+                                TLS handshake
+        """
+        self.host = host
+        self.port = int(port)
+        if context is None:
+            context = ssl.create_default_context()
+            if serverName is None:
+                context.check_hostname = False
+        self.context = context
+        self.serverName = serverName
+        self.connectTimeout = float(connectTimeout)
+        self._sock = None
+        self._session = None
+        self._ids = IdAllocator()
+        # Map of id -> _Waiter for queries that have been sent
+        self._waiters = {}
+        # Queries waiting for the I/O thread to send them
+        self._queue = []
+        self._lock = threading.Lock()
+        self._closed = False
+        # A pipe used to wake up the I/O thread
+        self._wakeR , self._wakeW = os.pipe()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __len__(self):
+        """
+        Returns the number of outstanding queries
+        """
+        return len(self._ids)
+
+    def submit(self , req , timeout , callback=None , **kwargs):
+        """
+        Send a query.  If a callback is given, it is called from the
+        I/O thread with the DnsResult, or an exception instance if the
+        query fails or times out.  The callback should not block.
+        Returns the waiter, which query() uses to wait for the answer.
+
+        req:DnsRequest      The request.  Its id is changed to one that
+                            is unique on this connection
+        timeout:float       The timeout in seconds
+        callback:func       An optional callback
+        """
+        if self._closed:
+            raise ResError('The connection to %s is closed' % self.host)
+        id = self._ids.alloc()
+        if id is None:
+            raise ResError('Too many queries in flight to %s' % self.host)
+        req.setId(id)
+        w = _Waiter(id , req.getBuf() , time.time() + float(timeout) ,
+            callback , kwargs)
+        with self._lock:
+            self._waiters[id] = w
+            self._queue.append(w)
+        self._wake()
+        return w
+
+    def query(self , req , timeout):
+        """
+        Send a query and block until the answer comes back.  Returns
+        the DnsResult or raises a TimeoutError or ResError
+        """
+        return self.wait(self.submit(req , timeout) , timeout)
+
+    def queryMany(self , reqs , timeout):
+        """
+        Pipeline a list of queries and wait for all the answers.
+        Returns a list of DnsResult objects or exception instances in
+        the same order as the requests
+
+        reqs:list[DnsRequest]       The requests
+        timeout:float|list[float]   The timeout for all the requests, or
+                                    a list with one per request
+        """
+        if not isinstance(timeout , (list , tuple)):
+            timeout = [timeout] * len(reqs)
+        waiters = []
+        for req , to in zip(reqs , timeout):
+            try:
+                waiters.append(self.submit(req , to))
+            except ResError , e:
+                waiters.append(e)
+        ret = []
+        for w , to in zip(waiters , timeout):
+            if isinstance(w , Exception):
+                ret.append(w)
+                continue
+            try:
+                ret.append(self.wait(w , to))
+            except (TimeoutError , ResError) , e:
+                ret.append(e)
+        return ret
+
+    def wait(self , w , timeout):
+        """
+        Wait for the answer to a submitted query
+        """
+        w.event.wait(max(w.deadline - time.time() , 0) + 0.05)
+        if not w.event.isSet():
+            if not self._fail(w , TimeoutError('Hit timeout of %f when '
+                    'querying %s over TLS' % (timeout , self.host))):
+                # The I/O thread got the answer first and is about to
+                # hand it over
+                w.event.wait()
+        if isinstance(w.result , Exception):
+            raise w.result
+        return w.result
+
+    def close(self):
+        """
+        Close the connection and stop the I/O thread.  Any outstanding
+        queries fail with a ResError
+        """
+        self._closed = True
+        self._wake()
+        self._thread.join(2)
+
+    def _wake(self):
+        try:
+            os.write(self._wakeW , 'x')
+        except OSError:
+            pass
+
+    def _fail(self , w , err):
+        """
+        Finish a waiter with an error if it hasn't been answered yet.
+        Returns False if something else has already taken it
+        """
+        with self._lock:
+            # The id may already have been given to a newer query
+            if self._waiters.get(w.id) is not w:
+                return False
+            del self._waiters[w.id]
+            try:
+                self._queue.remove(w)
+            except ValueError:
+                pass
+        self._ids.release(w.id)
+        w.finish(err)
+        return True
+
+    def _connect(self):
+        raw = socket.create_connection((self.host , self.port) ,
+            self.connectTimeout)
+        raw.setsockopt(socket.IPPROTO_TCP , socket.TCP_NODELAY , 1)
+        kwargs = {'server_hostname': self.serverName}
+        if self._session is not None:
+            kwargs['session'] = self._session
+        sock = self.context.wrap_socket(raw , **kwargs)
+        if hasattr(sock , 'session'):
+            # Save the session so a reconnect can resume it
+            self._session = sock.session
+        sock.setblocking(False)
+        return sock
+
+    def _disconnect(self , err):
+        """
+        Drop the connection and requeue anything that was sent but not
+        answered so it is sent again on the next connection
+        """
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except:
+                pass
+            self._sock = None
+        with self._lock:
+            queued = set(self._queue)
+            self._queue = [w for w in self._waiters.itervalues()
+                if w not in queued] + self._queue
+        logging.debug('DoT connection to %s dropped: %s' % (self.host ,
+            err))
+
+    def _run(self):
+        """
+        The I/O loop
+        """
+        inBuf = ''
+        outBuf = ''
+        while not self._closed:
+            with self._lock:
+                if self._queue:
+                    outBuf += ''.join([LEN16.pack(len(w.packet)) + w.packet
+                        for w in self._queue])
+                    self._queue = []
+                pending = bool(self._waiters)
+            if self._sock is None and (outBuf or pending):
+                try:
+                    self._sock = self._connect()
+                except (socket.error , ssl.SSLError ,
+                        ssl.CertificateError) , e:
+                    self._failAll(ResError('Could not connect to %s: %s' %
+                        (self.host , e)))
+                    outBuf = ''
+                    continue
+                inBuf = ''
+            rList = [self._wakeR]
+            wList = []
+            if self._sock is not None:
+                rList.append(self._sock)
+                if outBuf:
+                    wList.append(self._sock)
+            try:
+                r , w , x = select.select(rList , wList , [] , 0.1)
+            except select.error , e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if self._wakeR in r:
+                os.read(self._wakeR , 4096)
+            try:
+                if self._sock is not None and outBuf and (w or r):
+                    outBuf = self._write(outBuf)
+                if self._sock is not None and self._sock in r:
+                    inBuf = self._read(inBuf)
+            except (socket.error , ssl.SSLError , EOFError) , e:
+                self._disconnect(e)
+                outBuf = ''
+                inBuf = ''
+            self._expire()
+        if self._sock is not None:
+            self._sock.close()
+        self._failAll(ResError('The connection to %s was closed' %
+            self.host))
+        os.close(self._wakeR)
+        os.close(self._wakeW)
+
+    def _write(self , outBuf):
+        """
+        Write as much as we can, returning what is left
+        """
+        while outBuf:
+            try:
+                n = self._sock.send(outBuf)
+            except (ssl.SSLWantWriteError , ssl.SSLWantReadError):
+                break
+            except socket.error , e:
+                if e.errno in (errno.EAGAIN , errno.EWOULDBLOCK):
+                    break
+                raise
+            outBuf = outBuf[n:]
+        return outBuf
+
+    def _read(self , inBuf):
+        """
+        Read everything available, dispatch any complete responses and
+        return what is left over
+        """
+        err = None
+        while True:
+            try:
+                data = self._sock.recv(65535)
+            except (ssl.SSLWantReadError , ssl.SSLWantWriteError):
+                break
+            except (socket.error , ssl.SSLError) , e:
+                if e.errno in (errno.EAGAIN , errno.EWOULDBLOCK):
+                    break
+                err = e
+                break
+            if not data:
+                err = EOFError('Connection closed by %s' % self.host)
+                break
+            inBuf += data
+        inBuf = self._dispatchAll(inBuf)
+        if err is not None:
+            # Answers that came in before the connection dropped have
+            # been handled above, so only the rest are resent
+            raise err
+        return inBuf
+
+    def _dispatchAll(self , inBuf):
+        """
+        Dispatch all the complete responses in the buffer and return
+        what is left over
+        """
+        off = 0
+        while len(inBuf) - off >= 2:
+            l = LEN16.unpack_from(inBuf , off)[0]
+            if len(inBuf) - off - 2 < l:
+                break
+            self._dispatch(inBuf[off + 2:off + 2 + l])
+            off += 2 + l
+        return inBuf[off:]
+
+    def _dispatch(self , packet):
+        try:
+            res = drr.DnsResult(packet)
+        except ResError , e:
+            logging.warning('Dropping invalid result from %s: %s' % (
+                self.host , e))
+            return
+        with self._lock:
+            w = self._waiters.pop(res.id , None)
+        if w is None:
+            logging.warning('Found non-matching id in result, '
+                'dropping: %s' % res.id)
+            return
+        self._ids.release(w.id)
+        w.finish(res)
+
+    def _expire(self):
+        now = time.time()
+        with self._lock:
+            expired = [w for w in self._waiters.itervalues()
+                if w.deadline <= now]
+        for w in expired:
+            self._fail(w , TimeoutError('Hit timeout when querying %s '
+                'over TLS' % self.host))
+
+    def _failAll(self , err):
+        with self._lock:
+            waiters = self._waiters.values()
+        for w in waiters:
+            self._fail(w , err)
@@ -0,0 +1,158 @@
+"""
+Transaction id allocation.  Ids are handed out from a per socket pool
+of free ids so that no two outstanding queries on a socket ever share
+an id, and are chosen with the system's cryptographic random source so
+they can't be predicted.
+"""
+
+import os , struct , threading
+
+__all__ = ['IdAllocator' , 'SocketIdPool' , 'randomId']
+
+# The number of possible ids in a DNS message
+ID_SPACE = 65536
+
+class _RandomSource(object):
+    """
+    Hands out random ints from os.urandom(), reading the random bytes
+    in chunks to avoid a syscall for every id
+    """
+    chunkSize = 4096
+
+    def __init__(self):
+        self._buf = ''
+        self._off = 0
+        self._lock = threading.Lock()
+
+    def below(self , n):
+        """
+        Returns a random int in the range [0 , n)
+        """
+        with self._lock:
+            if self._off + 4 > len(self._buf):
+                self._buf = os.urandom(self.chunkSize)
+                self._off = 0
+            r = struct.unpack_from('!L' , self._buf , self._off)[0]
+            self._off += 4
+        # n is at most 65536 so the modulo bias here is negligible
+        return r % n
+
+_rand = _RandomSource()
+
+def randomId():
+    """
+    Returns an unpredictable id for a single query
+    """
+    return _rand.below(ID_SPACE)
+
+class IdAllocator(object):
+    """
+    A pool of free ids for a single socket.  alloc() picks uniformly at
+    random from the ids that are not currently in use and release()
+    puts an id back in the pool.
+    """
+    def __init__(self):
+        self._free = range(ID_SPACE)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """
+        Returns the number of ids currently in use
+        """
+        return ID_SPACE - len(self._free)
+
+    def alloc(self):
+        """
+        Returns a free id or None if all the ids are in use
+        """
+        with self._lock:
+            if not self._free:
+                return None
+            # Swap a random free id to the end and pop it off
+            i = _rand.below(len(self._free))
+            free = self._free
+            free[i] , free[-1] = free[-1] , free[i]
+            return free.pop()
+
+    def release(self , id):
+        """
+        Return an id to the pool
+        """
+        with self._lock:
+            self._free.append(id)
+
+class SocketIdPool(object):
+    """
+    Manages a set of sockets to a single resolver, each with its own
+    IdAllocator.  When every socket has maxInFlight queries
+    outstanding, a new socket (and thus a new source port) is opened
+    with sockFactory.  This keeps the ids on each socket sparse, and
+    so hard to guess, and lets the number of outstanding queries to a
+    resolver grow past the 65536 ids a single socket has.
+    """
+    def __init__(self , sockFactory , maxInFlight=4096 , maxSocks=64):
+        """
+        sockFactory:func    A function that returns a new connected
+                            socket to the resolver
+        maxInFlight:int     The number of outstanding queries on a socket
+                            before another socket is opened
+        maxSocks:int        The maximum number of sockets to open.  Once
+                            reached, the sockets are filled past
+                            maxInFlight
+        """
+        self.sockFactory = sockFactory
+        self.maxInFlight = int(maxInFlight)
+        self.maxSocks = int(maxSocks)
+        # list of (sock , IdAllocator)
+        self.socks = []
+        self._allocs = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """
+        Returns the total number of ids in use across all the sockets
+        """
+        return sum([len(a) for s , a in self.socks])
+
+    def alloc(self):
+        """
+        Returns a tuple of (sock , id) to send a query with.  Returns
+        (None , None) if every id on every socket is in use
+        """
+        with self._lock:
+            for s , a in self.socks:
+                if len(a) < self.maxInFlight:
+                    return (s , a.alloc())
+            if len(self.socks) < self.maxSocks:
+                s = self.sockFactory()
+                a = IdAllocator()
+                self.socks.append((s , a))
+                self._allocs[s.fileno()] = a
+                return (s , a.alloc())
+            # We're at the socket limit, use the least loaded socket
+            s , a = min(self.socks , key=lambda sa: len(sa[1]))
+            id = a.alloc()
+            if id is None:
+                return (None , None)
+            return (s , id)
+
+    def release(self , sock , id):
+        """
+        Return an id to the pool for the socket it was allocated on
+        """
+        a = self._allocs.get(sock.fileno())
+        if a is not None:
+            a.release(id)
+
+    def close(self):
+        """
+        Close all the sockets
+        """
+        with self._lock:
+            for s , a in self.socks:
+                try:
+                    s.close()
+                except:
+                    pass
+            self.socks = []
+            self._allocs = {}
@@ -0,0 +1,267 @@
+"""
+Iterative resolution.  Instead of sending recursive queries to a
+resolver, IterativeDNS starts at the root servers and follows the
+referrals down to the authoritative servers for a name itself.  The
+delegations it learns along the way are cached by zone cut, so later
+lookups under the same zone go straight to its nameservers.
+"""
+
+import dnsreqres as drr
+from dns import DNS
+from errors import TimeoutError , ResError
+from . import *
+import socket , threading , time , random , Queue
+
+__all__ = ['IterativeDNS' , 'ROOT_HINTS']
+
+# The IPv4 addresses of a.root-servers.net through m.root-servers.net
+ROOT_HINTS = [
+    '198.41.0.4' ,
+    '170.247.170.2' ,
+    '192.33.4.12' ,
+    '199.7.91.13' ,
+    '192.203.230.10' ,
+    '192.5.5.241' ,
+    '192.112.36.4' ,
+    '198.97.190.53' ,
+    '192.36.148.17' ,
+    '192.58.128.30' ,
+    '193.0.14.129' ,
+    '199.7.83.42' ,
+    '202.12.27.33' ,
+]
+
+def _inZone(name , zone):
+    """
+    Returns True if name is zone or is below it.  The root zone is ''
+    """
+    return not zone or name == zone or name.endswith('.' + zone)
+
+class IterativeDNS(DNS):
+    """
+    Performs iterative lookups starting from the root servers.  All
+    queries are sent with recursion desired turned off, directly to
+    the authoritative servers.
+
+    The timeout for a lookup applies to each query sent to a
+    nameserver, not to the whole resolution.
+    """
+    def __init__(self , defaultTimeout=3.0 , rootHints=ROOT_HINTS ,
+            cache=None , port=53 , maxReferrals=20 , maxDepth=4 ,
+            useMmsg=True):
+        """
+        defaultTimeout:float    The time in seconds to wait for each
+                                nameserver to answer
+        rootHints:list[str]     The IP addresses of the root servers
+        cache:DnsCache          An optional cache for the final answers
+        port:int                The port the nameservers listen on
+        maxReferrals:int        The most referrals to follow for a
+                                single lookup
+        maxDepth:int            How deeply lookups for the addresses
+                                of nameservers without glue can nest
+        """
+        DNS.__init__(self , defaultTimeout , list(rootHints) ,
+            useFirstOnly=False , cache=cache , port=port , useMmsg=useMmsg)
+        self.maxReferrals = int(maxReferrals)
+        self.maxDepth = int(maxDepth)
+        # Map of zone -> (expires , [nameserver IPs]).  The root zone
+        # is '' and never expires
+        self._cuts = {'': (None , list(self.resolvers))}
+        self._cutLock = threading.Lock()
+
+    def _runBatch(self , todo , timeouts):
+        """
+        Each request in a batch is resolved iteratively in turn,
+        sharing the delegation cache
+        """
+        ret = []
+        for req , timeout in zip(todo , timeouts):
+            res = None
+            if self.cache is not None:
+                res = self.cache.get(req.qname , req.qtype , req.qclass)
+            if res is None:
+                try:
+                    res = self._doLookup(req , timeout)
+                except (TimeoutError , ResError) , e:
+                    res = e
+            ret.append(res)
+        return ret
+
+    def getDelegation(self , name):
+        """
+        Returns (zone , [nameserver IPs]) for the closest enclosing zone
+        cut of name that is in the delegation cache
+        """
+        labels = name.lower().rstrip('.').split('.')
+        now = time.time()
+        with self._cutLock:
+            for i in xrange(len(labels) + 1):
+                zone = '.'.join(labels[i:])
+                entry = self._cuts.get(zone)
+                if entry is None:
+                    continue
+                expires , servers = entry
+                if expires is not None and expires <= now:
+                    del self._cuts[zone]
+                    continue
+                return zone , list(servers)
+
+    def flushDelegations(self):
+        """
+        Remove everything but the root hints from the delegation cache
+        """
+        with self._cutLock:
+            root = self._cuts['']
+            self._cuts = {'': root}
+
+    def _doLookup(self , req , timeout , callback=None , **kwargs):
+        """
+        Resolve the request iteratively, starting from the closest
+        cached zone cut
+        """
+        res = self._iterate(req.qname , req.qtype , req.qclass ,
+            float(timeout) , 0)
+        self._cacheResult(res)
+        return res
+
+    def _iterate(self , qname , qtype , qclass , timeout , depth):
+        """
+        Follow the referrals for a name down to an authoritative answer
+        """
+        qname = qname.rstrip('.')
+        zone , servers = self.getDelegation(qname)
+        for i in xrange(self.maxReferrals):
+            req = drr.DnsRequest(qname , qtype , qclass , rd=0)
+            res = self._ask(req , servers , timeout)
+            if res.aa or res.answers or res.rcode != RCD_OK:
+                return res
+            referral = self._getReferral(res , qname , zone)
+            if referral is None:
+                # Not an answer and not a usable referral, so this is
+                # as good as it gets
+                return res
+            zone , nsNames , ttl , glue = referral
+            if not glue:
+                if depth >= self.maxDepth:
+                    raise ResError('Too many nested nameserver lookups '
+                        'resolving %s' % qname)
+                # Nameservers inside the zone can't be looked up
+                # without glue, so try the ones outside it
+                outside = [ns for ns in nsNames if not _inZone(ns , zone)]
+                glue = self._resolveNames(outside or nsNames , timeout ,
+                    depth + 1)
+                if not glue:
+                    raise ResError('Could not find the addresses of the '
+                        'nameservers for %s' % zone)
+            servers = glue
+            with self._cutLock:
+                self._cuts[zone] = (time.time() + ttl , list(servers))
+        raise ResError('Too many referrals resolving %s' % qname)
+
+    def _ask(self , req , servers , timeout):
+        """
+        Send the request to the servers, in random order, until one of
+        them gives a usable answer
+        """
+        servers = list(servers)
+        random.shuffle(servers)
+        err = None
+        for server in servers:
+            try:
+                res = self._askOne(req , server , timeout)
+            except (socket.error , ResError) , e:
+                err = e
+                continue
+            if res.rcode in (RCD_SERVFAIL , RCD_REFUSED):
+                # A lame server, try the next one
+                err = ResError('%s answered %s for %s' % (server ,
+                    res.rcode , req.qname))
+                continue
+            return res
+        if isinstance(err , socket.timeout):
+            raise TimeoutError('Hit timeout of %f when querying %r for '
+                '%s' % (timeout , servers , req.qname))
+        raise ResError('No nameserver answered for %s: %s' % (req.qname ,
+            err))
+
+    def _askOne(self , req , server , timeout):
+        sock = self._getSock(server , timeout)
+        qname = req.qname.rstrip('.').lower()
+        try:
+            sock.send(req.getBuf())
+            while True:
+                res = drr.DnsResult(sock.recv(65535))
+                # The question has to match as well as the id, so a
+                # spoofed answer needs more than a lucky id (RFC 5452)
+                if res.id == req.id and res.qtype == req.qtype and \
+                        res.qclass == req.qclass and \
+                        res.qname.rstrip('.').lower() == qname:
+                    return res
+        finally:
+            sock.close()
+
+    def _getReferral(self , res , qname , zone):
+        """
+        Returns (zone , [NS names] , ttl , [glue IPs]) for a referral
+        to a zone below the current one, or None if res isn't one.
+        Only glue for nameservers inside the new zone is returned
+        """
+        cut = None
+        nsNames = []
+        ttl = None
+        for name , qtype , qclass , rttl , data in res.authority:
+            if qtype != QT_NS:
+                continue
+            name = name.lower()
+            if name == zone or not _inZone(name , zone) or \
+                    not _inZone(qname.lower() , name):
+                # Only follow referrals down towards the name
+                continue
+            if cut is None:
+                cut = name
+            elif name != cut:
+                continue
+            nsNames.append(data.lower())
+            ttl = rttl if ttl is None else min(ttl , rttl)
+        if cut is None:
+            return None
+        glue = []
+        for name , qtype , qclass , rttl , data in res.additional:
+            name = name.lower()
+            # Only trust glue inside the delegated zone.  Addresses for
+            # nameservers anywhere else have to be looked up on their own
+            if qtype == QT_A and name in nsNames and _inZone(name , cut):
+                glue.append(data)
+        return cut , nsNames , ttl , glue
+
+    def _resolveNames(self , names , timeout , depth):
+        """
+        Look up the addresses of a list of nameservers in parallel.
+        Returns the addresses of the first one that resolves, or an
+        empty list if none of them do.  The lookups still running are
+        left to finish in the background
+        """
+        q = Queue.Queue()
+        def resolve(name):
+            addrs = []
+            try:
+                res = self._iterate(name , QT_A , CL_IN , timeout , depth)
+                addrs = [data for rname , qtype , qclass , ttl , data
+                    in res.answers if qtype == QT_A]
+            except (TimeoutError , ResError , socket.error):
+                pass
+            q.put(addrs)
+        for name in names:
+            t = threading.Thread(target=resolve , args=(name ,))
+            t.daemon = True
+            t.start()
+        # Allow a timeout for each referral a lookup can follow
+        deadline = time.time() + timeout * self.maxReferrals
+        for i in xrange(len(names)):
+            try:
+                addrs = q.get(True , max(deadline - time.time() , 0))
+            except Queue.Empty:
+                break
+            if addrs:
+                return addrs
+        return []
@@ -0,0 +1,266 @@
+"""
+Batched datagram sends and receives.  On Linux, sendmmsg(2) and
+recvmmsg(2) are used through ctypes to move many datagrams in a single
+syscall.  Everywhere else, this falls back to a send() or recv() call
+per datagram.
+
+The sockets used here must be connected UDP sockets.
+"""
+
+import ctypes , ctypes.util , socket , select , errno , sys , threading
+
+__all__ = ['HAVE_MMSG' , 'sendMany' , 'MmsgSender' , 'MmsgReceiver']
+
+class _IoVec(ctypes.Structure):
+    _fields_ = [
+        ('iov_base' , ctypes.c_void_p) ,
+        ('iov_len' , ctypes.c_size_t) ,
+    ]
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name' , ctypes.c_void_p) ,
+        ('msg_namelen' , ctypes.c_uint32) ,
+        ('msg_iov' , ctypes.POINTER(_IoVec)) ,
+        ('msg_iovlen' , ctypes.c_size_t) ,
+        ('msg_control' , ctypes.c_void_p) ,
+        ('msg_controllen' , ctypes.c_size_t) ,
+        ('msg_flags' , ctypes.c_int) ,
+    ]
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_hdr' , _MsgHdr) ,
+        ('msg_len' , ctypes.c_uint) ,
+    ]
+
+MSG_DONTWAIT = getattr(socket , 'MSG_DONTWAIT' , 0x40)
+MSG_TRUNC = getattr(socket , 'MSG_TRUNC' , 0x20)
+
+_libc = None
+HAVE_MMSG = False
+if sys.platform.startswith('linux'):
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') , use_errno=True)
+        _sendmmsg = _libc.sendmmsg
+        _sendmmsg.argtypes = [ctypes.c_int , ctypes.POINTER(_MMsgHdr) ,
+            ctypes.c_uint , ctypes.c_int]
+        _sendmmsg.restype = ctypes.c_int
+        _recvmmsg = _libc.recvmmsg
+        _recvmmsg.argtypes = [ctypes.c_int , ctypes.POINTER(_MMsgHdr) ,
+            ctypes.c_uint , ctypes.c_int , ctypes.c_void_p]
+        _recvmmsg.restype = ctypes.c_int
+        HAVE_MMSG = True
+    except (OSError , AttributeError , TypeError):
+        pass
+
+# Word offsets of msg_flags and msg_len in an mmsghdr when it is viewed
+# as an array of c_uint
+_MSG_WORDS = ctypes.sizeof(_MMsgHdr) // ctypes.sizeof(ctypes.c_uint)
+_FLAGS_WORD = (_MMsgHdr.msg_hdr.offset + _MsgHdr.msg_flags.offset) // \
+    ctypes.sizeof(ctypes.c_uint)
+_LEN_WORD = _MMsgHdr.msg_len.offset // ctypes.sizeof(ctypes.c_uint)
+# Word offset of iov_len in an iovec viewed as an array of c_size_t
+_IOV_WORDS = ctypes.sizeof(_IoVec) // ctypes.sizeof(ctypes.c_size_t)
+
+class _MmsgBuffers(object):
+    """
+    A preallocated set of count buffers of bufSize bytes along with the
+    iovec and mmsghdr arrays pointing at them.  The buffers live in a
+    single bytearray so they can be filled and read with plain slicing
+    instead of a ctypes call per packet
+    """
+    def __init__(self , count , bufSize):
+        self.count = int(count)
+        self.bufSize = int(bufSize)
+        self.buf = bytearray(self.count * self.bufSize)
+        self.view = memoryview(self.buf)
+        self.offsets = range(0 , len(self.buf) , self.bufSize)
+        base = ctypes.addressof((ctypes.c_char * len(self.buf)).from_buffer(
+            self.buf))
+        self.iovs = (_IoVec * self.count)()
+        self.msgs = (_MMsgHdr * self.count)()
+        for i in xrange(self.count):
+            self.iovs[i].iov_base = base + i * self.bufSize
+            self.iovs[i].iov_len = self.bufSize
+            self.msgs[i].msg_hdr.msg_iov = ctypes.pointer(self.iovs[i])
+            self.msgs[i].msg_hdr.msg_iovlen = 1
+        # Integer views of the structures for fast field access
+        self.iovWords = (ctypes.c_size_t * (self.count * _IOV_WORDS)
+            ).from_buffer(self.iovs)
+        self.msgWords = (ctypes.c_uint * (self.count * _MSG_WORDS)
+            ).from_buffer(self.msgs)
+
+class MmsgSender(object):
+    """
+    Sends datagrams in batches from a set of preallocated buffers.  One
+    sender should be used per thread.
+    """
+    def __init__(self , count=64 , bufSize=4096 , useMmsg=True):
+        """
+        count:int       The most datagrams to send in one syscall
+        bufSize:int     The size of each send buffer.  Larger datagrams
+                        are sent on their own with send()
+        useMmsg:bool    Use sendmmsg() if it is available
+        """
+        self.count = int(count)
+        self.bufSize = int(bufSize)
+        self.useMmsg = useMmsg and HAVE_MMSG
+        if self.useMmsg:
+            self._bufs = _MmsgBuffers(self.count , self.bufSize)
+
+    def send(self , sock , packets):
+        """
+        Send a list of datagrams on a connected socket.  Returns the
+        number of datagrams sent
+
+        sock:socket             The connected socket
+        packets:list[str]       The datagrams to send
+        """
+        if not self.useMmsg:
+            for pkt in packets:
+                sock.send(pkt)
+            return len(packets)
+        sent = 0
+        batch = []
+        for pkt in packets:
+            if len(pkt) > self.bufSize:
+                # Too big for the buffers, flush what we have to keep
+                # the order and send this on its own
+                sent += self._sendBatch(sock , batch)
+                batch = []
+                sock.send(pkt)
+                sent += 1
+                continue
+            batch.append(pkt)
+            if len(batch) == self.count:
+                sent += self._sendBatch(sock , batch)
+                batch = []
+        sent += self._sendBatch(sock , batch)
+        return sent
+
+    def _sendBatch(self , sock , batch):
+        """
+        Copy a batch of at most count datagrams into the buffers and
+        send them
+        """
+        n = len(batch)
+        if not n:
+            return 0
+        bufs = self._bufs
+        buf = bufs.buf
+        size = self.bufSize
+        lens = [len(pkt) for pkt in batch]
+        for off , l , pkt in zip(xrange(0 , n * size , size) , lens , batch):
+            buf[off:off + l] = pkt
+        bufs.iovWords[1:n * _IOV_WORDS:_IOV_WORDS] = lens
+        return self._flush(sock , n)
+
+    def _flush(self , sock , n):
+        fd = sock.fileno()
+        msgs = self._bufs.msgs
+        sent = 0
+        while sent < n:
+            ret = _sendmmsg(fd , ctypes.pointer(msgs[sent]) , n - sent , 0)
+            if ret < 0:
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+                if err in (errno.EAGAIN , errno.EWOULDBLOCK):
+                    # Sockets with a timeout are non-blocking underneath,
+                    # so wait for the send buffer to drain
+                    select.select([] , [fd] , [] , sock.gettimeout())
+                    continue
+                raise socket.error(err , 'sendmmsg: %s' %
+                    errno.errorcode.get(err , err))
+            sent += ret
+        return sent
+
+_local = threading.local()
+
+def sendMany(sock , packets , useMmsg=True):
+    """
+    Send a list of datagrams on a connected socket, using as few
+    syscalls as possible.  This uses a per thread MmsgSender.  Returns
+    the number of datagrams sent
+
+    sock:socket             The connected socket
+    packets:list[str]       The datagrams to send
+    useMmsg:bool            Use sendmmsg() if it is available
+    """
+    if not (useMmsg and HAVE_MMSG):
+        for pkt in packets:
+            sock.send(pkt)
+        return len(packets)
+    sender = getattr(_local , 'sender' , None)
+    if sender is None:
+        sender = _local.sender = MmsgSender()
+    return sender.send(sock , packets)
+
+class MmsgReceiver(object):
+    """
+    Receives datagrams in batches into a set of preallocated buffers.
+    One receiver should be used per thread.
+    """
+    def __init__(self , count=64 , bufSize=4096 , useMmsg=True):
+        """
+        count:int       The most datagrams to read in one call
+        bufSize:int     The size of each receive buffer.  Datagrams
+                        that are larger than this are dropped
+        useMmsg:bool    Use recvmmsg() if it is available
+        """
+        self.count = int(count)
+        self.bufSize = int(bufSize)
+        self.useMmsg = useMmsg and HAVE_MMSG
+        if self.useMmsg:
+            self._bufs = _MmsgBuffers(self.count , self.bufSize)
+
+    def recv(self , sock):
+        """
+        Read all the datagrams waiting on the socket, up to count,
+        without blocking.  Returns a list of the datagrams, which will
+        be empty if nothing was waiting
+
+        sock:socket     The connected socket to read from
+        """
+        if not self.useMmsg:
+            return self._recvEach(sock)
+        bufs = self._bufs
+        while True:
+            ret = _recvmmsg(sock.fileno() , bufs.msgs , self.count ,
+                MSG_DONTWAIT , None)
+            if ret >= 0:
+                break
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if err in (errno.EAGAIN , errno.EWOULDBLOCK):
+                return []
+            raise socket.error(err , 'recvmmsg: %s' % errno.errorcode.get(
+                err , err))
+        words = bufs.msgWords
+        end = ret * _MSG_WORDS
+        lens = words[_LEN_WORD:end:_MSG_WORDS]
+        flags = words[_FLAGS_WORD:end:_MSG_WORDS]
+        view = bufs.view
+        return [view[off:off + l].tobytes() for off , l , f in
+            zip(bufs.offsets , lens , flags) if not f & MSG_TRUNC]
+
+    def _recvEach(self , sock):
+        ret = []
+        # Sockets with a timeout wait for data before each recv(), so
+        # make it non-blocking while we drain it
+        timeout = sock.gettimeout()
+        sock.settimeout(0.0)
+        try:
+            for i in xrange(self.count):
+                try:
+                    ret.append(sock.recv(self.bufSize , MSG_DONTWAIT))
+                except socket.error , e:
+                    if e.errno in (errno.EAGAIN , errno.EWOULDBLOCK ,
+                            errno.EINTR):
+                        break
+                    raise
+        finally:
+            sock.settimeout(timeout)
+        return ret
@@ -0,0 +1,403 @@
+"""
+A lightweight caching DNS forwarder.  It listens on a local UDP and TCP
+port, answers queries from a shared cache and forwards misses to the
+upstream resolvers with ADNS.  Identical queries that arrive while a
+lookup is already in flight are coalesced into a single upstream query.
+Truncated upstream answers are fetched again over TCP.
+
+Run it with:
+
+    python -m pyresolv.proxy -l 127.0.0.1 -p 5353 -r 192.0.2.53
+"""
+
+from . import *
+from .adns import ADNS
+from .cache import DnsCache
+from .errors import ResError
+from . import dnsreqres as drr
+from optparse import OptionParser
+import SocketServer
+import socket , struct , threading , time , logging , signal , sys
+
+__all__ = ['CachingForwarder']
+
+LEN16 = struct.Struct('!H')
+RR_TAIL = struct.Struct('!HHLH')
+# The largest UDP response for clients that don't use EDNS
+UDP_MAX = 512
+
+class CachingForwarder(object):
+    """
+    A caching forwarder that can be shared by all the processes on a
+    host.  Use start() to serve in background threads or
+    serveForever() to block.
+    """
+    def __init__(self , listenAddr='127.0.0.1' , listenPort=53 ,
+            resolvers=[] , resolvConf='/etc/resolv.conf' , cache=None ,
+            timeout=3.0 , upstreamPort=53 , tcp=True):
+        """
+        listenAddr:str      The local address to listen on
+        listenPort:int      The port to listen on.  Use 0 to pick a
+                            free port; see the "port" attribute
+        resolvers:list[str] The upstream resolvers.  These are parsed
+                            from resolvConf if not specified
+        resolvConf:str      The path to the resolv.conf file
+        cache:DnsCache      The cache to use.  A new one is created if
+                            not specified
+        timeout:float       The upstream query timeout in seconds
+        upstreamPort:int    The port the upstream resolvers listen on
+        tcp:bool            Also listen for TCP queries
+        """
+        if cache is None:
+            cache = DnsCache()
+        self.cache = cache
+        self.timeout = float(timeout)
+        self.upstreamPort = int(upstreamPort)
+        self.resolver = ADNS(self.timeout , list(resolvers) , resolvConf ,
+            cache=cache , port=upstreamPort)
+        # Map of (qname , qtype , qclass) -> list of
+        # (replyFunc , query , maxSize)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._udp = _UDPServer((listenAddr , listenPort) , _UDPHandler)
+        self._udp.forwarder = self
+        self.port = self._udp.server_address[1]
+        self._tcp = None
+        if tcp:
+            self._tcp = _TCPServer((listenAddr , self.port) , _TCPHandler)
+            self._tcp.forwarder = self
+        self._threads = []
+
+    def start(self):
+        """
+        Start serving in background threads
+        """
+        for server in (self._udp , self._tcp):
+            if server is None:
+                continue
+            t = threading.Thread(target=server.serve_forever)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def serveForever(self):
+        """
+        Serve until shutdown() is called
+        """
+        self.start()
+        while self._threads and self._threads[0].isAlive():
+            self._threads[0].join(1)
+
+    def shutdown(self):
+        """
+        Stop serving and close the sockets
+        """
+        for server in (self._udp , self._tcp):
+            if server is None:
+                continue
+            server.shutdown()
+            server.server_close()
+        self.resolver.close()
+
+    def handleQuery(self , data , reply , tcp=False):
+        """
+        Handle a single raw query.  The reply function is called with
+        the raw response, possibly from another thread
+
+        data:str        The raw query
+        reply:func      A function that sends a raw response back to
+                        the client
+        tcp:bool        Whether the query came over TCP.  Responses
+                        to UDP queries that are too big for the client
+                        are truncated
+        """
+        try:
+            q = drr.DnsResult(data)
+        except ResError:
+            # Not even a header and question we can parse, drop it
+            return
+        if q.qr or q.opcode != OPC_QUERY or q.qdcount != 1:
+            reply(self._errResponse(q , RCD_NOT_IMPL))
+            return
+        maxSize = None if tcp else self._udpSize(q)
+        entry = self.cache.getEntry(q.qname , q.qtype , q.qclass)
+        if entry is not None:
+            res , expires = entry
+            reply(self._response(res.rawBuf , q , maxSize ,
+                int(expires - time.time())))
+            return
+        key = (q.qname.lower() , q.qtype , q.qclass)
+        with self._lock:
+            waiters = self._pending.get(key)
+            if waiters is not None:
+                # Already in flight, just wait for that answer
+                waiters.append((reply , q , maxSize))
+                return
+            self._pending[key] = [(reply , q , maxSize)]
+        self.resolver.lookup(q.qname , q.qtype , qclass=q.qclass ,
+            rd=q.rd , callback=self._onAnswer , key=key)
+
+    def _onAnswer(self , res , key=None):
+        """
+        The ADNS callback.  Sends the answer to everyone waiting on it,
+        or fetches it again over TCP if it was truncated
+        """
+        if not isinstance(res , Exception) and res.tc:
+            # Don't hold up the other callbacks while we do this
+            t = threading.Thread(target=self._retryTcp , args=(res , key))
+            t.daemon = True
+            t.start()
+            return
+        self._deliver(res , key)
+
+    def _retryTcp(self , res , key):
+        """
+        Look up a truncated answer again over TCP and cache the full
+        answer.  If that fails, the truncated one is sent on so that
+        the clients can try for themselves
+        """
+        try:
+            full = self._tcpLookup(res)
+        except (socket.error , ResError) , e:
+            logging.warning('TCP retry for %s failed: %s' % (res.qname , e))
+        else:
+            self.cache.put(full)
+            res = full
+        self._deliver(res , key)
+
+    def _tcpLookup(self , res):
+        """
+        Send the query for a result to the upstream resolvers over TCP
+        and return the answer from the first one that gives one
+        """
+        req = drr.DnsRequest(res.qname , res.qtype , res.qclass ,
+            rd=res.rd)
+        packet = req.getBuf()
+        err = None
+        for resolver in self.resolver.resolvers:
+            try:
+                sock = socket.create_connection((resolver ,
+                    self.upstreamPort) , self.timeout)
+            except socket.error , e:
+                err = e
+                continue
+            try:
+                sock.sendall(LEN16.pack(len(packet)) + packet)
+                l = _recvAll(sock , 2)
+                if l is None:
+                    raise ResError('%s closed the connection' % resolver)
+                data = _recvAll(sock , LEN16.unpack(l)[0])
+                if data is None:
+                    raise ResError('%s closed the connection' % resolver)
+            except (socket.error , ResError) , e:
+                err = e
+                continue
+            finally:
+                sock.close()
+            full = drr.DnsResult(data)
+            if full.id != req.id:
+                err = ResError('Mismatched id in the TCP answer from %s' %
+                    resolver)
+                continue
+            return full
+        raise err or ResError('No upstream resolvers')
+
+    def _deliver(self , res , key):
+        """
+        Send a result to everyone waiting on it
+        """
+        with self._lock:
+            waiters = self._pending.pop(key , [])
+        for reply , q , maxSize in waiters:
+            if isinstance(res , Exception):
+                resp = self._errResponse(q , RCD_SERVFAIL)
+            else:
+                resp = self._response(res.rawBuf , q , maxSize)
+            try:
+                reply(resp)
+            except Exception , e:
+                logging.warning('Failed to send reply for %s: %s' %
+                    (q.qname , e))
+
+    def _udpSize(self , q):
+        """
+        Returns the largest UDP response the client can take, from the
+        EDNS OPT record in its query if it has one
+        """
+        for name , qtype , payload , ttl , data in q.additional:
+            if qtype == QT_OPT:
+                return max(payload , UDP_MAX)
+        return UDP_MAX
+
+    def _response(self , raw , q , maxSize , maxTTL=None):
+        """
+        Make the response to send to a client from a raw answer.  If
+        it doesn't fit in maxSize, only the header and question are
+        sent, with the TC bit set, so the client retries over TCP
+        """
+        resp = self._rewrite(raw , q , maxTTL)
+        if maxSize is not None and len(resp) > maxSize:
+            qEnd = _skipName(bytearray(resp) , 12) + 4
+            flags , qdcount = struct.unpack_from('!HH' , resp , 2)
+            resp = resp[:2] + struct.pack('!HHHHH' , flags | 0x0200 ,
+                qdcount , 0 , 0 , 0) + resp[12:qEnd]
+        return resp
+
+    def _errResponse(self , q , rcode):
+        """
+        Build an error response for a query
+        """
+        b = drr.DnsMessageBuilder(q.id , qr=1 , opcode=q.opcode , rd=q.rd ,
+            ra=1 , rcode=rcode)
+        if q.qdcount:
+            b.addQuestion(q.qname , q.qtype , q.qclass)
+        return b.getBuf()
+
+    def _rewrite(self , raw , q , maxTTL=None):
+        """
+        Rewrite the id and the question of a response to match the
+        client's query, which can differ in case from the one that
+        was sent upstream.  If maxTTL is set, also cap all the record
+        TTLs to it so cached answers count down
+        """
+        buf = bytearray(raw)
+        LEN16.pack_into(buf , 0 , q.id)
+        try:
+            # The names only differ in case, so the question is the
+            # same length and compression pointers past it still work
+            query = bytearray(q.rawBuf)
+            qLen = _skipName(query , 12) + 4 - 12
+            if _skipName(buf , 12) + 4 - 12 == qLen:
+                buf[12:12 + qLen] = query[12:12 + qLen]
+        except IndexError:
+            pass
+        if maxTTL is None:
+            return str(buf)
+        maxTTL = max(maxTTL , 0)
+        try:
+            qdcount , ancount , nscount , arcount = struct.unpack_from(
+                '!HHHH' , buf , 4)
+            off = 12
+            for i in xrange(qdcount):
+                off = _skipName(buf , off) + 4
+            for i in xrange(ancount + nscount + arcount):
+                off = _skipName(buf , off)
+                rtype , rclass , ttl , rdlen = RR_TAIL.unpack_from(buf , off)
+                if rtype != QT_OPT and ttl > maxTTL:
+                    struct.pack_into('!L' , buf , off + 4 , maxTTL)
+                off += RR_TAIL.size + rdlen
+        except (struct.error , IndexError):
+            # Leave whatever we couldn't walk alone
+            pass
+        return str(buf)
+
+def _recvAll(sock , n):
+    """
+    Read exactly n bytes from a socket.  Returns None if the
+    connection is closed first
+    """
+    buf = ''
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            return None
+        buf += chunk
+    return buf
+
+def _skipName(buf , off):
+    """
+    Returns the offset just past the name at off in a bytearray
+    """
+    while True:
+        l = buf[off]
+        if l & 0xC0 == 0xC0:
+            return off + 2
+        if l == 0:
+            return off + 1
+        off += l + 1
+
+# Queries are handed off to ADNS, so a single thread is enough for UDP
+class _UDPServer(SocketServer.UDPServer):
+    allow_reuse_address = True
+    max_packet_size = 65535
+
+class _TCPServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+class _UDPHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        data , sock = self.request
+        addr = self.client_address
+        self.server.forwarder.handleQuery(data ,
+            lambda resp: sock.sendto(resp , addr))
+
+class _TCPHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        sock = self.request
+        sock.settimeout(self.server.forwarder.timeout * 4)
+        sendLock = threading.Lock()
+        def reply(resp):
+            with sendLock:
+                sock.sendall(LEN16.pack(len(resp)) + resp)
+        try:
+            while True:
+                l = _recvAll(sock , 2)
+                if not l:
+                    break
+                data = _recvAll(sock , LEN16.unpack(l)[0])
+                if data is None:
+                    break
+                self.server.forwarder.handleQuery(data , reply , True)
+        except Exception , e:
+            logging.debug('TCP client %s closed: %s' % (
+                self.client_address , e))
+
+def getOpts():
+    p = OptionParser(usage='python -m pyresolv.proxy [options]')
+    p.add_option('-l' , '--listen' , dest='listen' , default='127.0.0.1' ,
+        help='The address to listen on [default: %default]')
+    p.add_option('-p' , '--port' , dest='port' , type='int' , default=53 ,
+        help='The port to listen on [default: %default]')
+    p.add_option('-r' , '--resolver' , dest='resolvers' , action='append' ,
+        default=[] , help='An upstream resolver.  Can be specified '
+        'multiple times.  Defaults to those in /etc/resolv.conf')
+    p.add_option('-u' , '--upstream-port' , dest='uport' , type='int' ,
+        default=53 , help='The upstream resolver port [default: %default]')
+    p.add_option('-t' , '--timeout' , dest='timeout' , type='float' ,
+        default=3.0 , help='The upstream timeout in seconds '
+        '[default: %default]')
+    p.add_option('-s' , '--snapshot' , dest='snapshot' , default=None ,
+        help='A cache snapshot file to load at startup and save on '
+        'shutdown')
+    p.add_option('--no-tcp' , dest='tcp' , action='store_false' ,
+        default=True , help='Do not listen on TCP')
+    opts , args = p.parse_args()
+    return opts
+
+def main():
+    opts = getOpts()
+    logging.basicConfig(level=logging.INFO)
+    cache = DnsCache()
+    if opts.snapshot:
+        try:
+            cache.load(opts.snapshot)
+        except (IOError , ResError) , e:
+            logging.warning('Could not load snapshot %s: %s' % (
+                opts.snapshot , e))
+    fwd = CachingForwarder(opts.listen , opts.port , opts.resolvers ,
+        cache=cache , timeout=opts.timeout , upstreamPort=opts.uport ,
+        tcp=opts.tcp)
+    signal.signal(signal.SIGTERM , lambda *args: sys.exit(0))
+    logging.info('Listening on %s:%d' % (opts.listen , fwd.port))
+    try:
+        fwd.serveForever()
+    except (KeyboardInterrupt , SystemExit):
+        pass
+    finally:
+        fwd.shutdown()
+        if opts.snapshot:
+            cache.save(opts.snapshot)
+
+if __name__ == '__main__':
+    main()
@@ -11,7 +11,8 @@ setup(name='py-resolv' ,
     packages=['pyresolv'] ,
     package_dir={'pyresolv': 'pyresolv'} ,
     data_files=[ ('share/pyresolv' , ['examples/async_ex.py' ,
-                                      'examples/sync_ex.py']) ] ,
+                                      'examples/sync_ex.py' ,
+                                      'examples/mmsg_bench.py']) ] ,
     classifiers=[
         'Development Status :: 2 - Pre-Alpha' ,
         'Intended Audience :: Developers' ,
@@ -0,0 +1,162 @@
+"""
+Stub DNS servers on localhost for the tests
+"""
+
+from pyresolv import *
+from pyresolv import dnsreqres as drr
+import socket , threading , ssl , struct , os
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# A self-signed certificate for dot.test
+CERT = os.path.join(HERE , 'dot-cert.pem')
+KEY = os.path.join(HERE , 'dot-key.pem')
+LEN16 = struct.Struct('!H')
+
+def answerA(addr='192.0.2.1' , ttl=60 , drop=()):
+    """
+    Returns a handler that answers every A query with addr and
+    everything else with no data.  Queries for the names in drop are
+    not answered
+    """
+    def handler(q):
+        if q.qname in drop:
+            return None
+        b = drr.DnsMessageBuilder(q.id , qr=1 , rd=q.rd , ra=1)
+        b.addQuestion(q.qname , q.qtype , q.qclass)
+        if q.qtype == QT_A:
+            b.addAnswer(q.qname , QT_A , ttl , addr)
+        return b.getBuf()
+    return handler
+
+class UdpStub(object):
+    """
+    A UDP DNS server that answers each query with handler(query), which
+    returns the raw response, a list of responses to send one after the
+    other, or None to drop the query
+    """
+    def __init__(self , handler , addr='127.0.0.1' , port=0):
+        self.handler = handler
+        self.queries = []
+        self.sock = socket.socket(socket.AF_INET , socket.SOCK_DGRAM)
+        # Don't let the stub be the one dropping queries under load
+        self.sock.setsockopt(socket.SOL_SOCKET , socket.SO_RCVBUF ,
+            4 * 1024 * 1024)
+        self.sock.bind((addr , port))
+        self.addr , self.port = self.sock.getsockname()
+        t = threading.Thread(target=self._run)
+        t.daemon = True
+        t.start()
+
+    def close(self):
+        self.sock.close()
+
+    def _run(self):
+        while True:
+            try:
+                data , client = self.sock.recvfrom(65535)
+            except socket.error:
+                return
+            q = drr.DnsResult(data)
+            self.queries.append(q)
+            resp = self.handler(q)
+            if resp is None:
+                continue
+            if not isinstance(resp , list):
+                resp = [resp]
+            for packet in resp:
+                self.sock.sendto(packet , client)
+
+class TcpStub(object):
+    """
+    A DNS over TCP server.  Each query is answered with handler(query)
+    unless it returns None.
+
+    batch:int       Hold the answers until this many queries have come
+                    in on the connection, then send them in reverse
+                    order
+    closeAfter:int  Close the connection after answering this many
+                    queries on it
+    """
+    ctx = None
+
+    def __init__(self , handler , batch=1 , closeAfter=None ,
+            addr='127.0.0.1' , port=0):
+        self.handler = handler
+        self.batch = batch
+        self.closeAfter = closeAfter
+        self.conns = 0
+        self.queries = []
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET , socket.SO_REUSEADDR , 1)
+        self.sock.bind((addr , port))
+        self.sock.listen(16)
+        self.addr , self.port = self.sock.getsockname()
+        t = threading.Thread(target=self._accept)
+        t.daemon = True
+        t.start()
+
+    def close(self):
+        self.sock.close()
+
+    def _accept(self):
+        while True:
+            try:
+                conn , client = self.sock.accept()
+            except socket.error:
+                return
+            self.conns += 1
+            t = threading.Thread(target=self._handle , args=(conn ,))
+            t.daemon = True
+            t.start()
+
+    def _handle(self , conn):
+        if self.ctx is not None:
+            try:
+                conn = self.ctx.wrap_socket(conn , server_side=True)
+            except (ssl.SSLError , socket.error):
+                # Such as a client that rejected the certificate
+                return
+        buf = ''
+        held = []
+        answered = 0
+        while True:
+            try:
+                data = conn.recv(65535)
+            except (ssl.SSLError , socket.error):
+                break
+            if not data:
+                break
+            buf += data
+            while len(buf) >= 2:
+                l = LEN16.unpack(buf[:2])[0]
+                if len(buf) < l + 2:
+                    break
+                q = drr.DnsResult(buf[2:l + 2])
+                buf = buf[l + 2:]
+                self.queries.append(q)
+                resp = self.handler(q)
+                if resp is not None:
+                    held.append(LEN16.pack(len(resp)) + resp)
+            if len(held) < self.batch:
+                continue
+            held.reverse()
+            if self.closeAfter is not None:
+                held = held[:self.closeAfter - answered]
+            conn.sendall(''.join(held))
+            answered += len(held)
+            held = []
+            if self.closeAfter is not None and answered >= self.closeAfter:
+                break
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        conn.close()
+
+class TlsStub(TcpStub):
+    """
+    A DNS over TLS server using the self-signed certificate for
+    dot.test in this directory
+    """
+    ctx = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    ctx.load_cert_chain(CERT , KEY)
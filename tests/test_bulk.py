@@ -0,0 +1,47 @@
+"""
+Tests for the command line bulk resolver
+"""
+
+from pyresolv.__main__ import BulkRunner , DEFAULT_CONCURRENCY
+from pyresolv.adns import ADNS
+from pyresolv import *
+from StringIO import StringIO
+import stubs
+import unittest , json
+
+class TestBulkRunner(unittest.TestCase):
+    def setUp(self):
+        self.stub = stubs.UdpStub(stubs.answerA())
+
+    def tearDown(self):
+        self.stub.close()
+
+    def _run(self , names , concurrency=DEFAULT_CONCURRENCY):
+        # Set up the same way as the command line does it
+        resolver = ADNS(3.0 , [self.stub.addr] , port=self.stub.port ,
+            maxPending=concurrency)
+        out = StringIO()
+        runner = BulkRunner(resolver , QT_A , concurrency , out)
+        try:
+            runner.run(names)
+        finally:
+            resolver.close()
+        return runner , [json.loads(l) for l in out.getvalue().splitlines()]
+
+    def testNoTimeouts(self):
+        names = ['n%d.example.com\n' % i for i in xrange(10000)]
+        runner , results = self._run(iter(names))
+        self.assertEqual(len(results) , len(names))
+        self.assertEqual([r for r in results if 'error' in r] , [])
+        self.assertEqual(runner.stats.errors , 0)
+        self.assertEqual(runner.stats.ok , len(names))
+
+    def testSkipsBlankAndComments(self):
+        runner , results = self._run(['a.example.com' , '' , '# x' ,
+            'b.example.com'] , 10)
+        self.assertEqual(sorted([r['name'] for r in results]) ,
+            ['a.example.com' , 'b.example.com'])
+        self.assertEqual(results[0]['answers'][0][4] , '192.0.2.1')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+"""
+Tests for DNS over TLS against a local stub with a self-signed
+certificate
+"""
+
+from pyresolv.dot import DotConnection
+from pyresolv.dns import DNS
+from pyresolv.adns import ADNS
+from pyresolv.errors import TimeoutError , ResError
+from pyresolv import dnsreqres as drr
+from pyresolv import *
+import stubs
+import unittest , ssl , threading , time
+
+def clientContext():
+    return ssl.create_default_context(cafile=stubs.CERT)
+
+class TestDotConnection(unittest.TestCase):
+    def _connect(self , stub , serverName='dot.test'):
+        conn = DotConnection(stub.addr , stub.port , clientContext() ,
+            serverName)
+        self.addCleanup(conn.close)
+        return conn
+
+    def _stub(self , **kwargs):
+        stub = stubs.TlsStub(stubs.answerA(drop=('drop.test' ,)) ,
+            **kwargs)
+        self.addCleanup(stub.close)
+        return stub
+
+    def _reqs(self , n):
+        return [drr.DnsRequest('n%d.test' % i) for i in xrange(n)]
+
+    def testQuery(self):
+        conn = self._connect(self._stub())
+        res = conn.query(drr.DnsRequest('www.test') , 2)
+        self.assertEqual(res.answers , [('www.test' , QT_A , CL_IN , 60 ,
+            '192.0.2.1')])
+
+    def testReverseOrder(self):
+        # The stub holds all the answers and sends them back last first
+        stub = self._stub(batch=10)
+        conn = self._connect(stub)
+        reqs = self._reqs(10)
+        results = conn.queryMany(reqs , 2)
+        self.assertEqual([res.qname for res in results] ,
+            [req.qname for req in reqs])
+        self.assertEqual(stub.conns , 1)
+
+    def testReconnect(self):
+        # The stub closes the connection after 3 answers, leaving the
+        # rest to be sent again on a new connection
+        stub = self._stub(closeAfter=3)
+        conn = self._connect(stub)
+        reqs = self._reqs(10)
+        results = conn.queryMany(reqs , 5)
+        self.assertEqual([getattr(res , 'qname' , res) for res in results] ,
+            [req.qname for req in reqs])
+        self.assertTrue(stub.conns > 1)
+        # The connection is reopened for later queries too
+        res = conn.query(drr.DnsRequest('later.test') , 2)
+        self.assertEqual(res.qname , 'later.test')
+
+    def testTimeout(self):
+        conn = self._connect(self._stub())
+        self.assertRaises(TimeoutError , conn.query ,
+            drr.DnsRequest('drop.test') , 0.2)
+        self.assertEqual(len(conn) , 0)
+
+    def testBadName(self):
+        conn = self._connect(self._stub() , 'other.test')
+        self.assertRaises(ResError , conn.query , drr.DnsRequest('x.test') ,
+            2)
+
+    def testAnswerRacesTimeout(self):
+        # The I/O thread has taken the waiter when the wait times out,
+        # but hasn't set the result yet
+        conn = self._connect(self._stub())
+        w = conn.submit(drr.DnsRequest('drop.test') , 0.1)
+        with conn._lock:
+            del conn._waiters[w.id]
+        res = drr.DnsResult(stubs.answerA()(drr.DnsRequest('drop.test')))
+        t = threading.Timer(0.5 , w.finish , args=(res ,))
+        t.start()
+        self.assertTrue(conn.wait(w , 0.1) is res)
+
+class TestDotResolvers(unittest.TestCase):
+    def setUp(self):
+        self.stub = stubs.TlsStub(stubs.answerA() , batch=5)
+
+    def tearDown(self):
+        self.stub.close()
+
+    def _kwargs(self):
+        return dict(port=self.stub.port , useTls=True ,
+            tlsContext=clientContext() , tlsServerName='dot.test')
+
+    def testDnsBatch(self):
+        resolver = DNS(2 , [self.stub.addr] , **self._kwargs())
+        try:
+            names = ['b%d.test' % i for i in xrange(5)]
+            results = resolver.batch([(name , QT_A) for name in names])
+        finally:
+            resolver.close()
+        self.assertEqual([res.answers[0][0] for req , res in results] ,
+            names)
+        self.assertEqual(self.stub.conns , 1)
+
+    def testAdns(self):
+        resolver = ADNS(2 , [self.stub.addr] , **self._kwargs())
+        results = {}
+        done = threading.Semaphore(0)
+        def cb(res , name=None):
+            results[name] = res
+            done.release()
+        try:
+            for i in xrange(5):
+                name = 'a%d.test' % i
+                resolver.lookup(name , callback=cb , name=name)
+            for i in xrange(5):
+                done.acquire()
+        finally:
+            resolver.close()
+        self.assertEqual(sorted([(name , res.qname) for name , res in
+            results.items()]) , [('a%d.test' % i ,) * 2 for i in xrange(5)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+"""
+Tests for iterative resolution against a hierarchy of root, TLD and
+authoritative stub servers on 127.0.0.x
+"""
+
+from pyresolv.iterative import IterativeDNS
+from pyresolv import dnsreqres as drr
+from pyresolv import *
+import stubs
+import unittest , socket
+
+ROOT = '127.0.0.1'
+COM = '127.0.0.2'
+EXAMPLE = '127.0.0.3'
+HOSTER = '127.0.0.4'
+NET = '127.0.0.5'
+SPOOF = '127.0.0.6'
+POISON = '127.0.0.9'
+
+def zone(name , records={} , delegations={}):
+    """
+    Returns a handler for an authoritative server for a zone.
+
+    records:dict        (name , qtype) -> [rdata]
+    delegations:dict    child zone -> [(NS name , glue address or None)]
+    """
+    def handler(q):
+        qname = q.qname.lower()
+        for child , servers in delegations.items():
+            if qname == child or qname.endswith('.' + child):
+                b = drr.DnsMessageBuilder(q.id , qr=1 , rd=q.rd)
+                b.addQuestion(q.qname , q.qtype , q.qclass)
+                for ns , glue in servers:
+                    b.addAuthority(child , QT_NS , 3600 , ns)
+                for ns , glue in servers:
+                    if glue:
+                        b.addAdditional(ns , QT_A , 3600 , glue)
+                return b.getBuf()
+        answers = records.get((qname , q.qtype) , [])
+        exists = [key for key in records if key[0] == qname]
+        b = drr.DnsMessageBuilder(q.id , qr=1 , aa=1 , rd=q.rd ,
+            rcode=RCD_OK if exists else RCD_NAME_ERR)
+        b.addQuestion(q.qname , q.qtype , q.qclass)
+        for rdata in answers:
+            b.addAnswer(q.qname , q.qtype , 300 , rdata)
+        if not answers:
+            b.addAuthority(name , QT_SOA , 300 , ('ns.' + name ,
+                'hostmaster.' + name , 1 , 3600 , 600 , 86400 , 60))
+        return b.getBuf()
+    return handler
+
+def freePort():
+    sock = socket.socket(socket.AF_INET , socket.SOCK_DGRAM)
+    sock.bind((ROOT , 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+class TestIterativeDNS(unittest.TestCase):
+    def setUp(self):
+        self.port = freePort()
+        self.servers = {}
+        self._serve(ROOT , zone('' , delegations={
+            'com': [('ns.com' , COM)] ,
+            'net': [('ns.net' , NET)]}))
+        self._serve(COM , zone('com' , delegations={
+            'example.com': [('ns1.example.com' , EXAMPLE)] ,
+            # The glue for a nameserver outside the child zone can't
+            # be trusted
+            'hosted.com': [('ns.hoster.net' , POISON)]}))
+        self._serve(NET , zone('net' , delegations={
+            'hoster.net': [('ns.hoster.net' , HOSTER)]}))
+        self._serve(EXAMPLE , zone('example.com' , {
+            ('www.example.com' , QT_A): ['192.0.2.1'] ,
+            ('mail.example.com' , QT_A): ['192.0.2.2']}))
+        self._serve(HOSTER , zone('hoster.net' , {
+            ('ns.hoster.net' , QT_A): [HOSTER] ,
+            ('www.hosted.com' , QT_A): ['192.0.2.3']}))
+        self._serve(POISON , zone('hosted.com' , {
+            ('www.hosted.com' , QT_A): ['198.51.100.1']}))
+        self.resolver = IterativeDNS(0.5 , rootHints=[ROOT] , port=self.port)
+
+    def tearDown(self):
+        for stub in self.servers.values():
+            stub.close()
+
+    def _serve(self , addr , handler):
+        self.servers[addr] = stubs.UdpStub(handler , addr , self.port)
+
+    def _counts(self):
+        return dict([(addr , len(stub.queries)) for addr , stub in
+            self.servers.items()])
+
+    def testResolve(self):
+        res = self.resolver.lookup('www.example.com')
+        self.assertEqual(res.answers , [('www.example.com' , QT_A , CL_IN ,
+            300 , '192.0.2.1')])
+        self.assertTrue(res.aa)
+        for q in self.servers[ROOT].queries + self.servers[COM].queries:
+            self.assertEqual(q.rd , 0)
+
+    def testNameError(self):
+        res = self.resolver.lookup('nope.example.com')
+        self.assertEqual(res.rcode , RCD_NAME_ERR)
+
+    def testDelegationCacheHit(self):
+        self.resolver.lookup('www.example.com')
+        self.assertEqual(self.resolver.getDelegation('mail.example.com') ,
+            ('example.com' , [EXAMPLE]))
+        before = self._counts()
+        res = self.resolver.lookup('mail.example.com')
+        self.assertEqual(res.answers[0][4] , '192.0.2.2')
+        after = self._counts()
+        # Only the authoritative server was asked the second time
+        self.assertEqual(after[EXAMPLE] , before[EXAMPLE] + 1)
+        for addr in (ROOT , COM , NET):
+            self.assertEqual(after[addr] , before[addr])
+        self.resolver.flushDelegations()
+        self.assertEqual(self.resolver.getDelegation('www.example.com') ,
+            ('' , [ROOT]))
+
+    def testOutOfBailiwickGlue(self):
+        res = self.resolver.lookup('www.hosted.com')
+        self.assertEqual(res.answers[0][4] , '192.0.2.3')
+        self.assertEqual(self.servers[POISON].queries , [])
+        self.assertEqual(self.resolver.getDelegation('www.hosted.com') ,
+            ('hosted.com' , [HOSTER]))
+
+    def testMismatchedQuestion(self):
+        # A server that sends answers for the wrong question, with the
+        # right id, ahead of the real answer
+        def spoof(q):
+            ret = []
+            for qname , qtype , addr in (('evil.test' , q.qtype ,
+                    '198.51.100.1') , (q.qname , QT_AAAA , '2001:db8::1') ,
+                    (q.qname.upper() , q.qtype , '192.0.2.4')):
+                b = drr.DnsMessageBuilder(q.id , qr=1 , aa=1 , rd=q.rd)
+                b.addQuestion(qname , qtype , q.qclass)
+                b.addAnswer(qname , qtype , 60 , addr)
+                ret.append(b.getBuf())
+            return ret
+        self._serve(SPOOF , spoof)
+        resolver = IterativeDNS(0.5 , rootHints=[SPOOF] , port=self.port)
+        res = resolver.lookup('www.test')
+        self.assertEqual(res.answers[0][4] , '192.0.2.4')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+"""
+Tests for the caching forwarder, with the forwarder and the upstream
+resolver both on localhost
+"""
+
+from pyresolv.proxy import CachingForwarder
+from pyresolv.cache import DnsCache
+from pyresolv import dnsreqres as drr
+from pyresolv import *
+import stubs
+import unittest , socket , struct , threading , time
+
+LEN16 = struct.Struct('!H')
+
+def bigAnswer(q , count=40):
+    b = drr.DnsMessageBuilder(q.id , qr=1 , rd=q.rd , ra=1)
+    b.addQuestion(q.qname , q.qtype , q.qclass)
+    for i in xrange(count):
+        b.addAnswer(q.qname , QT_A , 60 , '192.0.2.%d' % i)
+    return b.getBuf()
+
+def truncated(q):
+    b = drr.DnsMessageBuilder(q.id , qr=1 , tc=1 , rd=q.rd , ra=1)
+    b.addQuestion(q.qname , q.qtype , q.qclass)
+    return b.getBuf()
+
+class TestCachingForwarder(unittest.TestCase):
+    def _start(self , handler):
+        self.upstream = stubs.UdpStub(handler)
+        self.addCleanup(self.upstream.close)
+        self.fwd = CachingForwarder('127.0.0.1' , 0 ,
+            [self.upstream.addr] , cache=DnsCache() , timeout=2 ,
+            upstreamPort=self.upstream.port)
+        self.fwd.start()
+        self.addCleanup(self.fwd.shutdown)
+
+    def _udpQuery(self , name , qtype=QT_A):
+        req = drr.DnsRequest(name , qtype)
+        sock = socket.socket(socket.AF_INET , socket.SOCK_DGRAM)
+        sock.settimeout(3)
+        try:
+            sock.sendto(req.getBuf() , ('127.0.0.1' , self.fwd.port))
+            res = drr.DnsResult(sock.recv(65535))
+        finally:
+            sock.close()
+        self.assertEqual(res.id , req.id)
+        return res
+
+    def _tcpQuery(self , name , qtype=QT_A):
+        req = drr.DnsRequest(name , qtype)
+        packet = req.getBuf()
+        sock = socket.create_connection(('127.0.0.1' , self.fwd.port) , 3)
+        try:
+            sock.sendall(LEN16.pack(len(packet)) + packet)
+            f = sock.makefile('rb')
+            l = LEN16.unpack(f.read(2))[0]
+            res = drr.DnsResult(f.read(l))
+        finally:
+            sock.close()
+        self.assertEqual(res.id , req.id)
+        return res
+
+    def testForwardAndCache(self):
+        self._start(stubs.answerA(ttl=60))
+        res = self._udpQuery('www.example.com')
+        self.assertEqual(res.answers[0][4] , '192.0.2.1')
+        res = self._udpQuery('www.example.com')
+        self.assertEqual(res.answers[0][4] , '192.0.2.1')
+        self.assertEqual(len(self.upstream.queries) , 1)
+
+    def testTTLCountdown(self):
+        self._start(stubs.answerA(ttl=10))
+        self.assertEqual(self._udpQuery('www.example.com').answers[0][3] ,
+            10)
+        time.sleep(1.2)
+        ttl = self._udpQuery('www.example.com').answers[0][3]
+        self.assertTrue(ttl <= 9 , ttl)
+        self.assertEqual(len(self.upstream.queries) , 1)
+
+    def testQuestionCase(self):
+        # Clients using 0x20 case randomization check the question in
+        # the reply against what they sent
+        self._start(stubs.answerA())
+        self.assertEqual(self._udpQuery('www.example.com').qname ,
+            'www.example.com')
+        for name in ('WwW.eXaMpLe.CoM' , 'WWW.EXAMPLE.COM'):
+            self.assertEqual(self._udpQuery(name).qname , name)
+        self.assertEqual(len(self.upstream.queries) , 1)
+
+    def testCoalescing(self):
+        answer = stubs.answerA()
+        def slow(q):
+            time.sleep(0.3)
+            return answer(q)
+        self._start(slow)
+        names = ['www.example.com' , 'WWW.example.com' , 'www.EXAMPLE.com' ,
+            'Www.Example.Com' , 'www.example.COM']
+        results = {}
+        def query(name):
+            results[name] = self._udpQuery(name)
+        threads = [threading.Thread(target=query , args=(name ,))
+            for name in names]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(self.upstream.queries) , 1)
+        self.assertEqual(sorted(results) , sorted(names))
+        for name , res in results.items():
+            self.assertEqual(res.qname , name)
+            self.assertEqual(res.answers[0][4] , '192.0.2.1')
+
+    def testTcp(self):
+        self._start(stubs.answerA())
+        res = self._tcpQuery('tcp.example.com')
+        self.assertEqual(res.answers[0][4] , '192.0.2.1')
+
+    def testTruncatedRetriedOverTcp(self):
+        self._start(truncated)
+        tcp = stubs.TcpStub(bigAnswer , port=self.upstream.port)
+        self.addCleanup(tcp.close)
+        res = self._tcpQuery('big.example.com')
+        self.assertFalse(res.tc)
+        self.assertEqual(len(res.answers) , 40)
+        self.assertEqual(len(tcp.queries) , 1)
+        # The full answer is cached, but it is too big for a UDP client
+        # without EDNS, so that gets a truncated answer to retry with
+        res = self._udpQuery('big.example.com')
+        self.assertTrue(res.tc)
+        self.assertEqual(res.answers , [])
+        self.assertEqual(res.qname , 'big.example.com')
+        res = self._tcpQuery('big.example.com')
+        self.assertEqual(len(res.answers) , 40)
+        self.assertEqual(len(self.upstream.queries) , 1)
+        self.assertEqual(len(tcp.queries) , 1)
+
+if __name__ == '__main__':
+    unittest.main()